@@ -0,0 +1,500 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import folium
+from folium.plugins import MarkerCluster
+import geopandas as gpd
+import pandas as pd
+import pyproj
+
+import dataset_cache
+import db_functions
+import ingest_functions
+import stats_functions
+import tile_functions
+from dataset_cache import (archive_path, attribute_source, dataset_paths, map_copy_path, metadata_columns, projections,
+                           read_source)
+from dataset_index import build_index, query_index
+from export_functions import export_formats
+from file_index import FileIndex, format_mtime
+from filter_functions import categorize_columns, filter_geo_data
+from marker_functions import add_fire_markers
+from projection_functions import build_map_copy, get_transformer, reproject_geometries
+from stats_functions import cube_summary, summarize_burns, write_cube
+from vector_functions import features_geojson, simplify_geometries, simplify_zooms
+
+# Data sets used for the benchmarks, missing ones are skipped
+benchmark_data_sets = ['western_micronesia_2015_2023', 'Palau_Babeldaob_Fires_2012_2023']
+
+def load_data_sets():
+    frames = {}
+    for name in benchmark_data_sets:
+        shp_path, _ = dataset_paths(name)
+        if os.path.exists(shp_path):
+            frames[name] = gpd.read_file(shp_path)
+        else:
+            print(f"Skipping '{name}', no shapefile at {shp_path}")
+    return frames
+
+def scale_rows(gdf, rows):
+    # Repeat the data set until it holds the requested number of polygons.
+    # Geometries are shared between the copies so memory stays reasonable.
+    repeats = -(-rows // len(gdf))
+    scaled = pd.concat([gdf] * repeats, ignore_index=True).iloc[:rows]
+    return gpd.GeoDataFrame(scaled, geometry='geometry', crs=gdf.crs)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+# Row by row filter that flask_app used before the vectorized engine
+def legacy_filter_geo_data(gdf, years, months, islands):
+    filtered_rows = []
+
+    if years == ['']:
+        years = list(gdf['Year'].unique())
+    if months == ['']:
+        months = list(gdf['FireMonth'].unique())
+    if islands == ['']:
+        islands = list(gdf['Island'].unique())
+
+    for index, row in gdf.iterrows():
+        if row['Year'] in str(years) and row['FireMonth'] in months and row['Island'] in islands:
+            filtered_rows.append(row)
+
+    if not filtered_rows:
+        return gpd.GeoDataFrame(columns=gdf.columns, crs=gdf.crs)
+    return gpd.GeoDataFrame(filtered_rows, crs=gdf.crs, geometry='geometry')
+
+def bench_filter(rows=1000000, legacy_rows=50000):
+    for name, gdf in load_data_sets().items():
+        years = sorted(gdf['Year'].dropna().unique())[-3:]
+        months = ['January', 'February', 'March', 'April']
+        islands = list(gdf['Island'].dropna().unique())[:2]
+        request_years = [','.join(years)]
+
+        # Same answer as the legacy filter on a sample that it can get through
+        sample = scale_rows(gdf, min(rows, legacy_rows))
+        legacy, legacy_time = timed(legacy_filter_geo_data, sample, request_years, months, islands)
+        vectorized = filter_geo_data(categorize_columns(sample.copy()), request_years, months, islands)
+        assert list(legacy.index) == list(vectorized.index), 'vectorized filter changed the selection'
+
+        scaled = categorize_columns(scale_rows(gdf, rows))
+        result, vector_time = timed(filter_geo_data, scaled, request_years, months, islands)
+
+        legacy_estimate = legacy_time * rows / len(sample)
+        print(f"{name}: {rows} polygons, {len(result)} selected")
+        print(f"  legacy iterrows  {legacy_estimate:10.3f}s (extrapolated from {len(sample)} rows)")
+        print(f"  vectorized mask  {vector_time:10.3f}s ({legacy_estimate / vector_time:.0f}x faster)")
+
+def bench_index(rows=1000000):
+    for name, gdf in load_data_sets().items():
+        years = [','.join(sorted(gdf['Year'].dropna().unique())[-3:])]
+        months = ['January', 'February', 'March', 'April']
+        islands = list(gdf['Island'].dropna().unique())[:2]
+
+        # Each full month name must select the same rows either way
+        month_index = build_index(gdf)
+        for month in sorted(gdf['FireMonth'].dropna().unique()):
+            if list(filter_geo_data(gdf, None, [month], None).index) != list(query_index(month_index, None, [month], None)):
+                raise SystemExit(f"index query changed the selection of '{month}'")
+
+        scaled = categorize_columns(scale_rows(gdf, rows))
+        index, build_time = timed(build_index, scaled)
+        masked, mask_time = timed(filter_geo_data, scaled, years, months, islands)
+        row_ids, query_time = timed(query_index, index, years, months, islands)
+        if list(masked.index) != list(row_ids):
+            raise SystemExit('index query changed the selection')
+
+        print(f"{name}: {rows} polygons, {len(row_ids)} selected")
+        print(f"  index build      {build_time:10.3f}s (once, at ingest)")
+        print(f"  vectorized mask  {mask_time:10.4f}s")
+        print(f"  index query      {query_time:10.4f}s")
+
+def bench_reproject():
+    for name, gdf in load_data_sets().items():
+        # Work from a UTM copy so there is a real inverse projection to do
+        projected = gdf.to_crs(gdf.estimate_utm_crs())
+        prj = projected.crs.to_wkt()
+        polygons = [geom for geom in projected.geometry if geom.geom_type == 'Polygon']
+
+        def legacy():
+            proj = pyproj.Proj(prj)
+            return [[proj(x, y, inverse=True) for x, y in polygon.exterior.coords] for polygon in polygons]
+
+        _, legacy_time = timed(legacy)
+        _, batched_time = timed(reproject_geometries, projected.geometry.values, get_transformer(prj))
+
+        print(f"{name}: {len(projected)} polygons")
+        print(f"  per vertex Proj  {legacy_time:10.3f}s (polygon exteriors only)")
+        print(f"  batched          {batched_time:10.3f}s (all parts and holes)")
+
+def bench_concurrency(workers=8):
+    # Parallel /api/data requests that all share one id_num. Each asks for a
+    # different year/month pair so none is served from the map cache, and
+    # each response must only show the year it asked for.
+    import flask_app
+
+    name = 'Palau_Babeldaob_Fires_2012_2023'
+    client = flask_app.app.test_client()
+    id_num = client.get('/api/existing').get_json()['id_num']
+    index = flask_app.dataset_cache.get(name)['index']
+    years = sorted(index['Year'])
+    months = sorted(index['FireMonth'])
+    selections = [(year, month) for year in years for month in months
+                  if len(query_index(index, [year], [month], None))]
+
+    def request_map(selection):
+        year, month = selection
+        response = flask_app.app.test_client().get('/api/data', query_string={
+            'years': year, 'months': month, 'islands': '',
+            'id_num': id_num, 'dataSet': f'"{name}"',
+        })
+        if response.status_code != 200:
+            return f'{year}/{month}: HTTP {response.status_code}'
+        map_data = response.get_json()['map_data']
+        other_years = [other for other in years if other != year and f'<span>{other}</span>' in map_data]
+        if f'<span>{year}</span>' not in map_data or other_years:
+            return f'{year}/{month}: got the map for {other_years}'
+        return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failures = [failure for failure in pool.map(request_map, selections) if failure]
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(selections)} requests for id_num {id_num} on {workers} threads in {elapsed:.2f}s")
+    for failure in failures:
+        print(f"  FAILED {failure}")
+    # The repo has no test harness, this stands in for the concurrency test:
+    # python benchmark.py concurrency exits with status 1 when it fails,
+    # also under python -O where an assert would be skipped
+    if failures:
+        raise SystemExit('concurrent requests for one id_num interfered')
+    print("  every response matched its own selection")
+
+def bench_simplify():
+    for name, gdf in load_data_sets().items():
+        map_copy = gdf.to_crs('EPSG:4326')
+        full, full_time = timed(features_geojson, map_copy)
+        print(f"{name}: full resolution GeoJSON {len(full) / 1024:8.0f} KB ({full_time:.3f}s)")
+        for zoom in simplify_zooms:
+            simplified = map_copy.copy()
+            simplified['geometry'] = simplify_geometries(map_copy['geometry'].values, zoom)
+            payload, payload_time = timed(features_geojson, simplified)
+            print(f"  zoom {zoom:2d} level        {len(payload) / 1024:8.0f} KB ({payload_time:.3f}s, "
+                  f"{len(full) / len(payload):.1f}x smaller)")
+
+# Per row size class tally that render_filtered_map used before stats_functions
+def legacy_categorize_acreage(acreage):
+    if acreage <= 0.25:
+        return '0-0.25'
+    elif 0.26 <= acreage <= 9.99:
+        return '0.26-9'
+    elif 10.0 <= acreage <= 99.99:
+        return '10-99'
+    elif 100.0 <= acreage <= 299.99:
+        return '100-299'
+    elif 300.0 <= acreage <= 999.99:
+        return '300-999'
+    elif 1000.0 <= acreage <= 9999.99:
+        return '1000-9999'
+    else:
+        return 'Undefined'
+
+def legacy_size_classes(gdf):
+    category_data = {}
+    for index, row in gdf.iterrows():
+        acerage = round(row['Acerage'], 2)
+        category = category_data.setdefault(legacy_categorize_acreage(acerage), {'count': 0, 'acreage': 0.0})
+        category['count'] += 1
+        category['acreage'] += acerage
+    return category_data
+
+def bench_stats(rows=1000000, legacy_rows=50000):
+    for name, gdf in load_data_sets().items():
+        islands = list(gdf['Island'].dropna().unique())
+
+        # Same classes and counts as the legacy loop on a sample it can get through
+        sample = scale_rows(gdf, min(rows, legacy_rows))
+        legacy, legacy_time = timed(legacy_size_classes, sample)
+        summary = summarize_burns(sample, islands)
+        assert {row['sizeClass']: row['count'] for row in summary['sizeClasses']} == \
+            {category: values['count'] for category, values in legacy.items()}, 'size classes changed'
+
+        scaled = scale_rows(gdf, rows)
+        _, vector_time = timed(summarize_burns, scaled, islands)
+
+        legacy_estimate = legacy_time * rows / len(sample)
+        print(f"{name}: {rows} polygons")
+        print(f"  legacy iterrows  {legacy_estimate:10.3f}s (extrapolated from {len(sample)} rows)")
+        print(f"  pd.cut/groupby   {vector_time:10.3f}s ({legacy_estimate / vector_time:.0f}x faster)")
+
+        # The cube of the real data set gives the same legend for every year
+        cells, cube_time = timed(write_cube, name, categorize_columns(gdf.copy()))
+        cube_times = []
+        for year in [''] + sorted(gdf['Year'].dropna().unique()):
+            expected = summarize_burns(gdf[gdf['Year'] == year] if year else gdf, islands)
+            summary, summary_time = timed(cube_summary, name, year, '', '')
+            cube_times.append(summary_time)
+            assert [(row['sizeClass'], row['count'], str(round(row['acreage'], 2))) for row in summary['sizeClasses']] == \
+                [(row['sizeClass'], row['count'], str(round(row['acreage'], 2))) for row in expected['sizeClasses']], \
+                f'cube disagrees for year {year!r}'
+        print(f"  cube build       {cube_time:10.3f}s ({cells} cells of {len(gdf)} fires, once at ingest)")
+        print(f"  cube summary     {max(cube_times):10.4f}s (slowest of {len(cube_times)} selections)")
+
+# One folium.Marker with its own popup table per fire, as flask_app did
+# before marker_functions
+def legacy_add_fire_markers(m, gdf):
+    marker_cluster = MarkerCluster().add_to(m)
+    for (idx, row), centroid_lon, centroid_lat in zip(gdf.iterrows(), gdf['centroid_lon'], gdf['centroid_lat']):
+        acerage = round(row['Acerage'], 2)
+        table_html = f"""
+        <table style="border-collapse: collapse; width: 100px;">
+            <tr>
+                <td style="border: 1px solid black; padding: 8px;">Acres</td>
+                <td style="border: 1px solid black; padding: 8px;">{acerage}</td>
+            </tr>
+            <tr>
+                <td style="border: 1px solid black; padding: 8px;">Year</td>
+                <td style="border: 1px solid black; padding: 8px;">{int(row['Year'])}</td>
+            </tr>
+            <tr>
+                <td style="border: 1px solid black; padding: 8px;">Month</td>
+                <td style="border: 1px solid black; padding: 8px;">{row['FireMonth']}</td>
+            </tr>
+        </table>
+        """
+        folium.Marker([centroid_lat, centroid_lon], popup=table_html).add_to(marker_cluster)
+
+def bench_markers():
+    for name, gdf in load_data_sets().items():
+        with open(dataset_paths(name)[1], 'r') as prj_file:
+            map_copy = build_map_copy(gdf, prj_file.read())
+
+        # Markers only, the polygons and legends are the same either way
+        def render(add_markers):
+            m = folium.Map(location=[map_copy['centroid_lat'].iloc[0], map_copy['centroid_lon'].iloc[0]], zoom_start=10)
+            add_markers(m, map_copy)
+            return m.get_root().render()
+
+        legacy, legacy_time = timed(render, legacy_add_fire_markers)
+        bulk, bulk_time = timed(render, add_fire_markers)
+        print(f"{name}: {len(map_copy)} markers")
+        print(f"  folium.Marker    {legacy_time:10.3f}s {len(legacy) / 1024:8.0f} KB")
+        print(f"  FastMarkerCluster{bulk_time:10.3f}s {len(bulk) / 1024:8.0f} KB "
+              f"({legacy_time / bulk_time:.0f}x faster, {len(legacy) / len(bulk):.0f}x smaller)")
+
+# Four connections and four commits per map request, as db_functions did
+# before the connection pool
+def legacy_update_user_data_id(path, user_id, years, islands, months, map_data, data_set):
+    for statement, values in (("UPDATE user_data SET last_accessed = ? WHERE id = ?", (time.strftime('%Y-%m-%d %H:%M:%S'), user_id)),
+                              ("UPDATE user_data SET map_html = ? WHERE id = ?", (map_data, user_id)),
+                              ("UPDATE user_data SET data_set = ? WHERE id = ?", (data_set, user_id)),
+                              ("UPDATE user_data SET years = ?, islands = ?, months = ?, data_set = ? WHERE id = ?",
+                               (years, islands, months, data_set, user_id))):
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute(statement, values)
+        conn.commit()
+        conn.close()
+
+def bench_db(workers=8, requests_per_worker=200, map_bytes=200 * 1024):
+    map_data = 'x' * map_bytes
+    default_pool = db_functions.pool
+
+    with tempfile.TemporaryDirectory() as folder:
+        for label in ('legacy', 'pooled'):
+            path = os.path.join(folder, f'{label}.db')
+            db_functions.pool = db_functions.ConnectionPool(path, db_functions.pool_size)
+            db_functions.create_tables()
+            user_ids = [db_functions.insert_entry_with_checked_id() for _ in range(workers)]
+            if label == 'legacy':
+                # The legacy helpers ran on the default rollback journal
+                db_functions.pool.close()
+                sqlite3.connect(path).execute('PRAGMA journal_mode=DELETE').connection.close()
+
+            def worker(user_id):
+                for i in range(requests_per_worker):
+                    values = (user_id, str(2015 + i % 9), 'Guam', 'January', map_data, 'data_set')
+                    if label == 'legacy':
+                        legacy_update_user_data_id(path, *values)
+                    else:
+                        db_functions.update_user_data_id(*values)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(worker, user_ids))
+            elapsed = time.perf_counter() - start
+
+            # Every session ends up with the last selection its worker wrote
+            conn = sqlite3.connect(path)
+            rows = conn.execute("SELECT years, map_html IS NOT NULL OR map_ref IS NOT NULL FROM user_data WHERE id IN (%s)" %
+                                ','.join('?' * len(user_ids)), user_ids).fetchall()
+            conn.close()
+            assert rows == [(str(2015 + (requests_per_worker - 1) % 9), 1)] * workers, f'{label} lost an update'
+
+            total = workers * requests_per_worker
+            print(f"  {label:7s} {total} map requests on {workers} threads: {elapsed:7.2f}s "
+                  f"({total / elapsed:7.0f} requests/s)")
+            db_functions.pool.close()
+
+    db_functions.pool = default_pool
+
+def bench_export():
+    for name, gdf in load_data_sets().items():
+        print(f"{name}: {len(gdf)} fires")
+        with tempfile.TemporaryDirectory() as folder:
+            for fmt, (ext, _, writer) in export_formats.items():
+                path = os.path.join(folder, f'{name}.{ext}')
+                _, seconds = timed(writer, gdf, path, name)
+                size = os.path.getsize(path)
+                print(f"  {fmt:10s} {size / 1024:8.0f} KB {seconds:7.3f}s {size / seconds / 1024 / 1024:7.1f} MB/s")
+
+def legacy_get_files_in_directory(directory_path):
+    # /file-tree before the file index, every folder level walks its subtree
+    # again for the size
+    files = []
+    for item in os.listdir(directory_path):
+        item_path = os.path.join(directory_path, item)
+        is_directory = os.path.isdir(item_path)
+        file_object = {'id': item, 'name': item, 'isDir': is_directory, 'isHidden': is_directory, 'openable': False, 'files': []}
+        if is_directory:
+            file_object['files'] = legacy_get_files_in_directory(item_path)
+            file_object['size'] = sum(os.path.getsize(os.path.join(dirpath, f)) for dirpath, _, filenames in os.walk(item_path) for f in filenames)
+        else:
+            file_object['size'] = os.path.getsize(item_path)
+        file_object['modDate'] = format_mtime(os.path.getmtime(item_path))
+        files.append(file_object)
+    return files
+
+def bench_filetree(depth=5, folders=4, files=20):
+    # Synthetic archive tree: folders ** depth folders of files each
+    with tempfile.TemporaryDirectory() as root:
+        def make(path, level):
+            for i in range(files):
+                with open(os.path.join(path, f'file_{i}.dat'), 'wb') as f:
+                    f.write(b'x' * i)
+            if level < depth:
+                for i in range(folders):
+                    child = os.path.join(path, f'folder_{i}')
+                    os.mkdir(child)
+                    make(child, level + 1)
+        make(root, 1)
+
+        index = FileIndex(root)
+        _, build_seconds = timed(index.rebuild)
+        print(f"{index.stats()['paths']} paths, depth {depth}")
+        _, legacy_seconds = timed(legacy_get_files_in_directory, root)
+        print(f"  legacy walk per request   {legacy_seconds * 1000:9.1f} ms")
+        print(f"  index build (once)        {build_seconds * 1000:9.1f} ms")
+        _, seconds = timed(index.listing)
+        print(f"  cached full tree          {seconds * 1000:9.1f} ms")
+        _, seconds = timed(index.listing, '', 1, 0, 50)
+        print(f"  cached top level, depth 1 {seconds * 1000:9.1f} ms")
+        with open(os.path.join(root, 'folder_0', 'folder_0', 'new.dat'), 'wb') as f:
+            f.write(b'x' * 100)
+        _, seconds = timed(index.update, os.path.join('folder_0', 'folder_0', 'new.dat'))
+        print(f"  update one added file     {seconds * 1000:9.1f} ms")
+
+def folder_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+def bench_ingest(data_set='Palau_Babeldaob_Fires_2012_2023'):
+    # Full ingest job of an uploaded archive, extracted as before and read
+    # in place through /vsizip/, in a scratch data folder and database
+    upload = archive_path(data_set)
+    if not os.path.exists(upload):
+        print(f"Skipping '{data_set}', no archive at {upload}")
+        return
+    saved = (dataset_cache.data_root, ingest_functions.extract_uploads, ingest_functions.ingest_db,
+             stats_functions.stats_db, tile_functions.tile_cache_dir)
+    print(f"{data_set}: archive {os.path.getsize(upload) / 1024:.0f} KB")
+    try:
+        for extract in (True, False):
+            with tempfile.TemporaryDirectory() as folder:
+                root = os.path.join(folder, 'data')
+                os.mkdir(root)
+                zip_file = os.path.join(root, data_set + '.zip')
+                shutil.copy(upload, zip_file)
+                dataset_cache.data_root = root
+                ingest_functions.extract_uploads = extract
+                ingest_functions.ingest_db = stats_functions.stats_db = os.path.join(folder, 'data_sets.db')
+                tile_functions.tile_cache_dir = os.path.join(folder, 'tiles')
+                dataset_cache.dataset_cache.invalidate(data_set)
+                with ingest_functions.connect() as conn:
+                    ingest_functions.create_files_table(conn)
+                    ingest_functions.create_job_table(conn)
+                    job_id = conn.execute("INSERT INTO ingest_jobs (data_set, status) VALUES (?, 'queued')", (data_set,)).lastrowid
+
+                ok, seconds = timed(ingest_functions.run_ingest, job_id, zip_file)
+                source_bytes = folder_bytes(root) - os.path.getsize(zip_file)
+                derived_bytes = sum(os.path.getsize(os.path.join(root, data_set, f)) for f in os.listdir(os.path.join(root, data_set))
+                                    if '.wgs84.' in f or f.endswith('.idx.npz'))
+                print(f"  {'extracted' if extract else '/vsizip/ '} {'ok' if ok else 'failed'} {seconds:6.2f}s "
+                      f"data folder {folder_bytes(root) / 1024:6.0f} KB "
+                      f"(extracted parts {(source_bytes - derived_bytes) / 1024:5.0f} KB, derived {derived_bytes / 1024:5.0f} KB)")
+    finally:
+        (dataset_cache.data_root, ingest_functions.extract_uploads, ingest_functions.ingest_db,
+         stats_functions.stats_db, tile_functions.tile_cache_dir) = saved
+        dataset_cache.dataset_cache.invalidate(data_set)
+
+def frame_bytes(frame):
+    return int(frame.memory_usage(deep=True).sum())
+
+def bench_columns(repeats=5):
+    # Whole reads against the column projections the endpoints declare.
+    # Reads without geometry go to the .dbf alone, so they also work for a
+    # data set whose .shp is missing.
+    def best(function, *args):
+        results = [timed(function, *args) for _ in range(repeats)]
+        return results[0][0], min(seconds for _, seconds in results)
+
+    for name in benchmark_data_sets:
+        if not os.path.exists(attribute_source(name)):
+            print(f"Skipping '{name}', no .dbf at {attribute_source(name)}")
+            continue
+        shp_path, _ = dataset_paths(name)
+        reads = []
+        if os.path.exists(shp_path):
+            reads.append(('whole shapefile', read_source, name))
+        reads += [
+            ('all attributes, no geometry', read_source, name, None, False),
+            ('attributes projection', read_source, name, projections['attributes'][0], False),
+            ('ingest metadata projection', read_source, name, metadata_columns, False),
+        ]
+        if os.path.exists(map_copy_path(name)):
+            reads += [
+                ('whole map copy', gpd.read_parquet, map_copy_path(name)),
+                ('map projection', gpd.read_parquet, map_copy_path(name), projections['map'][0] + ['geometry']),
+            ]
+        print(name)
+        for label, function, *args in reads:
+            frame, seconds = best(function, *args)
+            print(f"  {label:28s} {seconds * 1000:8.1f} ms {frame_bytes(frame) / 1024:8.0f} KB {len(frame.columns):3d} columns")
+
+benchmarks = {
+    'filter': bench_filter,
+    'index': bench_index,
+    'reproject': bench_reproject,
+    'concurrency': bench_concurrency,
+    'simplify': bench_simplify,
+    'stats': bench_stats,
+    'markers': bench_markers,
+    'db': bench_db,
+    'export': bench_export,
+    'filetree': bench_filetree,
+    'ingest': bench_ingest,
+    'columns': bench_columns,
+}
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(benchmarks)
+    for bench_name in selected:
+        print(f"--- {bench_name} ---")
+        benchmarks[bench_name]()
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import threading
+import time
+
+# Set debug flag
+debug = False
+
+# Rendered maps saved for sessions, stored once per distinct content under
+# <blob_dir>/<first two hex digits>/<sha256>.html
+blob_dir = os.path.join('output', 'map_blobs')
+
+# Blobs younger than this are never collected, a session may be about to
+# point at one that was just written
+collect_grace_seconds = 10 * 60
+
+def blob_ref(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def blob_path(ref):
+    return os.path.join(blob_dir, ref[:2], ref + '.html')
+
+def put_blob(content):
+    # Returns the reference to store in place of the content
+    ref = blob_ref(content)
+    path = blob_path(ref)
+    if os.path.exists(path):
+        # Same map again, just mark it as recently used
+        os.utime(path)
+        return ref
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so readers never see half a file
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as blob_file:
+        blob_file.write(content)
+    os.replace(temp_path, path)
+    if debug:
+        print(f"Stored map blob {ref}")
+    return ref
+
+def blob_exists(ref):
+    return bool(ref) and os.path.exists(blob_path(ref))
+
+def read_blob(ref):
+    if not ref:
+        return None
+    try:
+        with open(blob_path(ref), 'r', encoding='utf-8') as blob_file:
+            return blob_file.read()
+    except FileNotFoundError:
+        return None
+
+def collect_blobs(live_refs):
+    # Deletes the blobs no session refers to anymore, returns how many
+    live_refs = set(live_refs)
+    cutoff = time.time() - collect_grace_seconds
+    removed = 0
+    if not os.path.isdir(blob_dir):
+        return removed
+    for prefix in os.scandir(blob_dir):
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            ref, ext = os.path.splitext(entry.name)
+            if ext != '.html' or ref in live_refs:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    if debug:
+        print(f"Removed {removed} unreferenced map blobs")
+    return removed
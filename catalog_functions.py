@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from dataset_cache import data_root
+from ingest_functions import check_unzipped, create_files_table, find_zip_files, ingest_db
+
+# Set debug flag
+debug = False
+
+# Seconds between checks of the data folder and database for changes made
+# outside this process, override with CATALOG_POLL_SECONDS (0 disables)
+catalog_poll_seconds = float(os.environ.get('CATALOG_POLL_SECONDS', 5))
+
+class DataCatalog:
+    # The data sets of the files table and their years, islands and months,
+    # held in memory so listing them needs no database or disk access.
+    # Reloaded after an upload or delete, and by a watcher thread when the
+    # data folder or the database changes.
+
+    def __init__(self, poll_seconds, on_archive=None):
+        self.poll_seconds = poll_seconds
+        # Called with the path of each archive found that isn't unzipped yet
+        self.on_archive = on_archive
+        self._names = []
+        self._entries = {}
+        self._version = ''
+        self._signature = None
+        self._refreshes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        with sqlite3.connect(ingest_db, timeout=30) as conn:
+            create_files_table(conn)
+            rows = conn.execute("SELECT file_name, total_islands, total_years, unique_months_str FROM files").fetchall()
+
+        names = [row[0].strip() for row in rows]
+        entries = {}
+        for name, (_, islands, years, months) in zip(names, rows):
+            entries[name] = {
+                'allYears': (years or '').split(','),
+                'allIslands': (islands or '').split(','),
+                'allMonths': (months or '').split(','),
+            }
+        version = hashlib.sha256(json.dumps([names, entries], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+        with self._lock:
+            self._names = names
+            self._entries = entries
+            self._version = version
+            self._refreshes += 1
+        if debug:
+            print(f"Catalog refreshed: {len(names)} data sets, version {version}")
+
+    def scan(self):
+        # Queues top level archives that haven't been unzipped, then reloads
+        # the list
+        if self.on_archive is not None:
+            for zip_file in find_zip_files(data_root):
+                if not check_unzipped(zip_file):
+                    self.on_archive(zip_file)
+        self.refresh()
+
+    def default_data_set(self):
+        with self._lock:
+            return self._names[0] if self._names else None
+
+    def listing(self, name):
+        # Returns the /api/list response for a data set, falling back to the
+        # default one, and an etag that changes with the catalog
+        with self._lock:
+            names, entries, version = self._names, self._entries, self._version
+        if name not in entries:
+            name = names[0] if names else None
+        if name is None:
+            return None, None
+        response_data = dict(entries[name], allDataSets=list(names))
+        return response_data, f'{version}-{hashlib.sha256(name.encode("utf-8")).hexdigest()[:16]}'
+
+    def stats(self):
+        with self._lock:
+            return {
+                'dataSets': len(self._names),
+                'version': self._version,
+                'refreshes': self._refreshes,
+                'pollSeconds': self.poll_seconds,
+                'running': self._thread is not None and self._thread.is_alive(),
+            }
+
+    def signature(self):
+        # Adding or removing an archive changes the folder mtime, registering
+        # or deleting a data set changes the database file
+        try:
+            return os.stat(data_root).st_mtime_ns, os.stat(ingest_db).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def start(self):
+        self._signature = self.signature()
+        self.scan()
+        if self.poll_seconds <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='data-catalog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.poll_seconds):
+            signature = self.signature()
+            if signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                self.scan()
+            except Exception as e:
+                print(f"Catalog scan failed: {e}")
@@ -0,0 +1,309 @@
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+from filter_functions import categorize_columns, filter_columns
+from projection_functions import build_map_copy, derived_columns
+from vector_functions import feature_properties, level_for_zoom, simplify_geometries, simplify_zooms
+from dataset_index import build_index, index_path, load_index, query_index, save_index
+
+# Set debug flag
+debug = False
+
+# Folder holding the uploaded data sets (ExampleFiles/<name>/<name>.shp)
+data_root = 'ExampleFiles'
+
+# Uploaded archives are extracted next to the zip unless EXTRACT_UPLOADS=0,
+# then the shapefile is read from inside the zip through GDAL's /vsizip/
+# and only the derived files are written to the data set folder
+extract_uploads = os.environ.get('EXTRACT_UPLOADS', '1') != '0'
+
+# Memory budget for parsed data sets, override with DATASET_CACHE_MB
+max_cache_bytes = int(os.environ.get('DATASET_CACHE_MB', 512)) * 1024 * 1024
+
+# Columns of the 'attributes' variant, all the filters and statistics need
+attribute_columns = list(filter_columns) + ['Acerage']
+
+# What each variant reads: (attribute columns or None for all of them,
+# whether the geometry is read). Everything else in the .dbf is skipped.
+# The map draws the polygons with their filter and popup values and
+# places markers at the precomputed centroids, statistics only need the
+# attributes, exports carry every column as uploaded.
+projections = {
+    'map': (list(dict.fromkeys(feature_properties + attribute_columns)) + derived_columns, True),
+    'attributes': (attribute_columns, False),
+    'source': (None, True),
+}
+
+# Year, month and island lists stored in the files table at ingest
+metadata_columns = list(filter_columns)
+
+def dataset_paths(name):
+    folder = os.path.join(data_root, name)
+    return os.path.join(folder, name + '.shp'), os.path.join(folder, name + '.prj')
+
+def archive_path(name):
+    return os.path.join(data_root, name + '.zip')
+
+def in_archive(name):
+    # True when the data set is only available inside its uploaded zip
+    shp_path, _ = dataset_paths(name)
+    return not os.path.exists(shp_path) and os.path.exists(archive_path(name))
+
+def dataset_source(name):
+    # Path GDAL reads the shapefile from, the extracted copy when there is
+    # one and the member of the uploaded zip otherwise
+    shp_path, _ = dataset_paths(name)
+    if in_archive(name):
+        return f'/vsizip/{archive_path(name)}/{name}/{name}.shp'
+    return shp_path
+
+def attribute_source(name):
+    # The .dbf on its own, for reads that need no geometry. It is opened
+    # without the .shp, so no polygon is read or even located.
+    return os.path.splitext(dataset_source(name))[0] + '.dbf'
+
+def read_source(name, columns=None, geometry=True):
+    # Only the given columns, all when None, and no geometry unless asked
+    if not geometry:
+        return gpd.read_file(attribute_source(name), columns=columns, ignore_geometry=True)
+    return gpd.read_file(dataset_source(name), columns=columns)
+
+def read_prj(name):
+    _, prj_path = dataset_paths(name)
+    if in_archive(name):
+        with zipfile.ZipFile(archive_path(name)) as zip_ref:
+            return zip_ref.read(f'{name}/{name}.prj').decode('utf-8')
+    with open(prj_path, 'r') as prj_file:
+        return prj_file.read()
+
+def source_mtime(name):
+    # Latest modification time of the files making up the shapefile, or of
+    # the zip holding them
+    if in_archive(name):
+        return os.path.getmtime(archive_path(name))
+    shp_path, prj_path = dataset_paths(name)
+    base = os.path.splitext(shp_path)[0]
+    mtimes = [os.path.getmtime(shp_path)]
+    for ext in ('.dbf', '.shx', '.prj'):
+        if os.path.exists(base + ext):
+            mtimes.append(os.path.getmtime(base + ext))
+    return max(mtimes)
+
+def estimate_size(gdf):
+    # memory_usage does not see the coordinates held by the shapely objects
+    if 'geometry' not in gdf.columns:
+        return int(gdf.memory_usage(deep=True).sum()) + len(gdf) * 100
+    size = int(gdf.drop(columns='geometry').memory_usage(deep=True).sum())
+    size += int(shapely.get_num_coordinates(gdf.geometry.values).sum()) * 16
+    return size + len(gdf) * 100
+
+def map_copy_path(name):
+    shp_path, _ = dataset_paths(name)
+    return os.path.splitext(shp_path)[0] + '.wgs84.parquet'
+
+def level_path(name, zoom):
+    shp_path, _ = dataset_paths(name)
+    return os.path.splitext(shp_path)[0] + f'.wgs84.z{zoom}.parquet'
+
+def is_derived_file(file_name):
+    # The attribute index and map copies written next to a shapefile are
+    # for the app's own use, not part of the data set a user downloads
+    return re.search(r'\.(idx\.npz|wgs84(\.z\d+)?\.parquet)$', file_name) is not None
+
+def write_map_copy(name, gdf=None):
+    # Saves the EPSG:4326 copy of a data set used by the map endpoints,
+    # plus one geometry-only file per simplified zoom level
+    if gdf is None:
+        gdf = categorize_columns(read_source(name))
+    prj = read_prj(name)
+
+    map_copy = build_map_copy(gdf, prj)
+    map_copy.to_parquet(map_copy_path(name))
+    write_levels(name, map_copy)
+    if debug:
+        print(f"Wrote WGS84 copy of '{name}' to {map_copy_path(name)}")
+    return map_copy
+
+def write_levels(name, map_copy):
+    levels = {}
+    for zoom in simplify_zooms:
+        levels[zoom] = simplify_geometries(map_copy['geometry'].values, zoom)
+        gpd.GeoDataFrame(geometry=levels[zoom], crs=map_copy.crs).to_parquet(level_path(name, zoom))
+    return levels
+
+def read_levels(name, mtime, rows):
+    # Simplified geometries by zoom, None if any level is missing or stale
+    levels = {}
+    for zoom in simplify_zooms:
+        path = level_path(name, zoom)
+        if not os.path.exists(path) or os.path.getmtime(path) < mtime:
+            return None
+        try:
+            levels[zoom] = gpd.read_parquet(path)['geometry'].values
+        except Exception as e:
+            print(f"Error reading '{path}': {e}")
+            return None
+        if len(levels[zoom]) != rows:
+            return None
+    return levels
+
+def read_map_copy(name, mtime, columns=None):
+    # None when the copy is missing or older than the shapefile
+    path = map_copy_path(name)
+    if not os.path.exists(path) or os.path.getmtime(path) < mtime:
+        return None
+    try:
+        return gpd.read_parquet(path, columns=None if columns is None else columns + ['geometry'])
+    except Exception as e:
+        print(f"Error reading '{path}': {e}")
+        return None
+
+def read_attributes(name, mtime, columns=None):
+    # Attribute columns only, from the parquet copy when it is current and
+    # from the .dbf otherwise. No geometry is read or parsed either way.
+    columns = attribute_columns if columns is None else columns
+    path = map_copy_path(name)
+    if os.path.exists(path) and os.path.getmtime(path) >= mtime:
+        try:
+            return pd.read_parquet(path, columns=columns)
+        except Exception as e:
+            print(f"Error reading '{path}': {e}")
+    return read_source(name, columns, geometry=False)
+
+class DatasetCache:
+    # Keeps parsed data sets in memory, least recently used ones are evicted
+    # once the memory budget is exceeded. Entries are reloaded when the
+    # shapefile changes on disk or when invalidate() is called.
+    # Each data set has a 'map' variant (the WGS84 copy), a 'source'
+    # variant (the shapefile as uploaded, used for downloads) and an
+    # 'attributes' variant (a plain DataFrame without geometry, for stats).
+    # Callers must treat the returned GeoDataFrame as read-only.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, variant='map'):
+        mtime = source_mtime(name)
+        key = (name, variant)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['mtime'] == mtime:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+
+        # Parse outside the lock so other data sets stay available meanwhile
+        entry = self._load(name, variant, mtime)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.current_bytes += entry['size']
+            # Never evict the entry that was just loaded
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+                if debug:
+                    print(f"Evicted data set '{oldest}' from cache")
+
+        return entry
+
+    def query(self, name, years, months, islands, variant='map', zoom=None):
+        # Rows of a data set matching the selection, answered from the
+        # attribute indexes instead of scanning the columns. With a zoom the
+        # geometry is swapped for the simplified level drawn at that zoom.
+        entry = self.get(name, variant)
+        row_ids = query_index(entry['index'], years, months, islands)
+        gdf = entry['gdf'].iloc[row_ids].copy()
+        level = level_for_zoom(zoom)
+        if level is not None and level in entry['levels']:
+            gdf['geometry'] = entry['levels'][level][row_ids]
+        return gdf
+
+    def invalidate(self, name=None):
+        with self._lock:
+            for key in list(self._entries):
+                if name is None or key[0] == name:
+                    self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': [f'{name}:{variant}' for name, variant in self._entries],
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry['size']
+
+    def _load(self, name, variant, mtime):
+        shp_path, _ = dataset_paths(name)
+
+        columns, geometry = projections[variant]
+        if not geometry:
+            gdf = categorize_columns(read_attributes(name, mtime, columns))
+        else:
+            gdf = read_map_copy(name, mtime, columns) if variant == 'map' else None
+        if gdf is None:
+            if debug:
+                print(f"Loading data set '{name}' from {dataset_source(name)}")
+            if variant == 'map':
+                # Missing or stale WGS84 copy, it keeps every column so it
+                # is written from the whole source
+                gdf = write_map_copy(name, categorize_columns(read_source(name)))[columns + ['geometry']]
+            else:
+                gdf = categorize_columns(read_source(name, columns))
+
+        prj = read_prj(name)
+
+        # Simplified geometry per zoom level for the map variant
+        levels = {}
+        if variant == 'map':
+            levels = read_levels(name, mtime, len(gdf))
+            if levels is None:
+                levels = write_levels(name, gdf)
+
+        # Indexes are written at ingest, rebuild them if that was skipped
+        index = load_index(index_path(shp_path), mtime)
+        if index is None or index['rows'] != len(gdf):
+            index = build_index(gdf)
+            save_index(index_path(shp_path), index, mtime)
+
+        return {
+            'name': name,
+            'variant': variant,
+            'gdf': gdf,
+            'prj': prj,
+            'index': index,
+            'levels': levels,
+            'mtime': mtime,
+            'size': estimate_size(gdf) + sum(
+                int(shapely.get_num_coordinates(geometries).sum()) * 16 for geometries in levels.values()),
+        }
+
+dataset_cache = DatasetCache(max_cache_bytes)
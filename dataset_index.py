@@ -0,0 +1,109 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from filter_functions import filter_columns, split_selection
+
+# Set debug flag
+debug = False
+
+# Bump when the layout of the saved index changes
+index_version = 2
+
+def index_path(shp_path):
+    return os.path.splitext(shp_path)[0] + '.idx.npz'
+
+def build_index(gdf):
+    # Inverted index per filter column: value -> sorted row ids.
+    # Row ids are positions in the order the shapefile is read.
+    index = {'rows': len(gdf)}
+    for column in filter_columns:
+        # Grouped on factorize codes, missing values get -1 and are left
+        # out as a selection never matches them. Keys are the values as
+        # strings, the form filter_data compares against.
+        codes, values = pd.factorize(gdf[column])
+        row_ids = np.flatnonzero(codes >= 0)
+        # Stable sort keeps the row ids of each value in ascending order
+        order = row_ids[np.argsort(codes[row_ids], kind='stable')]
+        unique_codes, starts = np.unique(codes[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        index[column] = {}
+        for code, start, end in zip(unique_codes, starts, ends):
+            key = str(values[code])
+            rows = order[start:end]
+            if key in index[column]:
+                # Two values that print the same, such as 1 and '1'
+                rows = np.sort(np.concatenate([index[column][key], rows]))
+            index[column][key] = rows
+    return index
+
+def save_index(path, index, source_mtime):
+    # Stored as one values/offsets/rows triple per column so loading is a
+    # handful of array reads instead of parsing a value per row
+    arrays = {
+        'version': np.array([index_version]),
+        'rows': np.array([index['rows']]),
+        'source_mtime': np.array([source_mtime]),
+    }
+    for column in filter_columns:
+        keys = list(index[column])
+        lengths = [len(index[column][key]) for key in keys]
+        arrays[column + '_values'] = np.array(keys, dtype=str)
+        arrays[column + '_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        arrays[column + '_rows'] = (np.concatenate([index[column][key] for key in keys])
+                                    if keys else np.array([], dtype=np.int64))
+    with open(path, 'wb') as index_file:
+        np.savez(index_file, **arrays)
+
+def load_index(path, source_mtime):
+    # Returns None when the index is missing or older than the shapefile
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as saved:
+            if int(saved['version'][0]) != index_version or float(saved['source_mtime'][0]) != source_mtime:
+                return None
+            index = {'rows': int(saved['rows'][0])}
+            for column in filter_columns:
+                keys = saved[column + '_values']
+                offsets = saved[column + '_offsets']
+                rows = saved[column + '_rows']
+                index[column] = {
+                    str(key): rows[offsets[i]:offsets[i + 1]]
+                    for i, key in enumerate(keys)
+                }
+            return index
+    except Exception as e:
+        print(f"Error reading index '{path}': {e}")
+        return None
+
+def write_dataset_index(shp_path, source_mtime, source=None):
+    # Called at ingest time, only the attribute table is needed. source is
+    # where to read it from when that isn't shp_path (a /vsizip/ path).
+    gdf = gpd.read_file(source or shp_path, columns=list(filter_columns), ignore_geometry=True)
+    index = build_index(gdf)
+    save_index(index_path(shp_path), index, source_mtime)
+    if debug:
+        print(f"Wrote attribute index for {shp_path}")
+    return index
+
+def query_index(index, years, months, islands):
+    # Sorted row ids matching the selection, an empty selection matches all
+    selected = None
+    for column, selection in zip(filter_columns, (years, months, islands)):
+        values = split_selection(selection)
+        if values is None:
+            continue
+        postings = [index[column][value] for value in set(values) if value in index[column]]
+        # A selection covering every row of the data set filters nothing
+        if sum(len(rows) for rows in postings) == index['rows']:
+            continue
+        matches = np.zeros(index['rows'], dtype=bool)
+        for rows in postings:
+            matches[rows] = True
+        selected = matches if selected is None else selected & matches
+    if selected is None:
+        return np.arange(index['rows'])
+    return np.flatnonzero(selected)
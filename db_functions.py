@@ -1,256 +1,484 @@
+import os
+import queue
 import sqlite3
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from blob_store import blob_exists, collect_blobs, put_blob, read_blob
 
 # Set debug flag
 debug = False
 
-# Connect to a database (this will create a new database if it doesn't exist)
-conn = sqlite3.connect('fire_users.db')
-cursor = conn.cursor()
-
-# Create a users table
-cursor.execute('''CREATE TABLE IF NOT EXISTS user_data (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT,
-                    years Text,
-                    islands Text,
-                    months Text,
-                    map_html TEXT,
-                    data_set Text,
-                    last_accessed DATETIME DEFAULT CURRENT_TIMESTAMP
-                )''')
-
-# SQLite DB setup
-
-cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-               file_name TEXT PRIMARY KEY, 
-               unzipped INTEGER, 
-               total_islands Text, 
-               total_years Text, 
-               unique_months_str TEXT)''')
+# Database holding the user sessions
+user_db = 'fire_users.db'
+
+# Connections kept open for the request threads, override with DB_POOL_SIZE
+pool_size = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Saved maps of sessions not seen for this long are dropped, override with
+# MAP_TTL_DAYS
+map_ttl_days = float(os.environ.get('MAP_TTL_DAYS', 30))
+
+# Sessions not seen for this long are deleted, override with
+# SESSION_TTL_DAYS
+session_ttl_days = float(os.environ.get('SESSION_TTL_DAYS', 90))
+
+# Seconds between janitor sweeps, SESSION_JANITOR_INTERVAL=0 turns it off
+janitor_interval = int(os.environ.get('SESSION_JANITOR_INTERVAL', 3600))
+
+# Applied to every pooled connection. WAL lets readers carry on while a
+# request is writing, and with WAL synchronous=NORMAL is still crash safe
+# without an fsync per commit. busy_timeout makes a writer wait for the
+# lock instead of failing straight away.
+connection_pragmas = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+]
+
+class ConnectionPool:
+    # Hands out open connections to one database, at most size of them at a
+    # time. A connection is only ever used by one thread until it is given
+    # back, so they can be shared across the request threads.
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.opened = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self.opened < self.size:
+                self.opened += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self.opened -= 1
+                    raise
+        return self._idle.get()
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    def replace(self, conn):
+        # Closes a connection that can't be reused and opens a new one in
+        # its place, so threads waiting for a connection still get one
+        conn.close()
+        try:
+            self._idle.put(self._open())
+        except Exception as e:
+            print(f"Error reopening a connection to {self.path}: {e}")
+            with self._lock:
+                self.opened -= 1
+
+    @contextmanager
+    def connection(self):
+        # For reads, a single SELECT needs no explicit transaction
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        # Everything inside is committed once, or rolled back on error.
+        # BEGIN IMMEDIATE takes the write lock up front so two writers can't
+        # both read and then deadlock trying to upgrade.
+        conn = self.acquire()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                # Also reached when COMMIT fails, SQLITE_BUSY leaves the
+                # transaction open
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        finally:
+            if conn.in_transaction:
+                # Even ROLLBACK failed, the next borrower mustn't inherit
+                # the transaction
+                self.replace(conn)
+            else:
+                self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self.opened -= 1
+
+    def _open(self):
+        # Autocommit mode, transactions are started explicitly above
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        for pragma in connection_pragmas:
+            conn.execute(pragma)
+        if debug:
+            print(f"Opened connection {self.opened} of {self.size} to {self.path}")
+        return conn
+
+pool = ConnectionPool(user_db, pool_size)
+
+def create_tables():
+    with pool.transaction() as conn:
+        # Create a users table
+        conn.execute('''CREATE TABLE IF NOT EXISTS user_data (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        years Text,
+                        islands Text,
+                        months Text,
+                        map_html TEXT,
+                        data_set Text,
+                        last_accessed DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )''')
+
+        # SQLite DB setup
+        conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                       file_name TEXT PRIMARY KEY,
+                       unzipped INTEGER,
+                       total_islands Text,
+                       total_years Text,
+                       unique_months_str TEXT)''')
+
+        # Rendered maps live in the blob store, the row only keeps a reference
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(user_data)")]
+        if 'map_ref' not in columns:
+            conn.execute("ALTER TABLE user_data ADD COLUMN map_ref TEXT")
+
+        # Tables made before AUTOINCREMENT are copied over once, keeping IDs
+        table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_data'").fetchone()[0]
+        if 'AUTOINCREMENT' not in table_sql.upper():
+            conn.execute('''CREATE TABLE user_data_new (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            name TEXT,
+                            years Text,
+                            islands Text,
+                            months Text,
+                            map_html TEXT,
+                            data_set Text,
+                            last_accessed DATETIME DEFAULT CURRENT_TIMESTAMP,
+                            map_ref TEXT
+                        )''')
+            conn.execute("INSERT INTO user_data_new (id, name, years, islands, months, map_html, data_set, last_accessed, map_ref) "
+                         "SELECT id, name, years, islands, months, map_html, data_set, last_accessed, map_ref FROM user_data")
+            conn.execute("DROP TABLE user_data")
+            conn.execute("ALTER TABLE user_data_new RENAME TO user_data")
+
+        # The janitor finds stale sessions through this index
+        conn.execute("CREATE INDEX IF NOT EXISTS user_data_last_accessed ON user_data (last_accessed)")
+
+def move_inline_maps(batch=50):
+    # Maps saved before the blob store are moved out of the map_html column
+    moved = 0
+    while True:
+        with pool.connection() as conn:
+            rows = conn.execute("SELECT id, map_html FROM user_data WHERE map_html IS NOT NULL LIMIT ?", (batch,)).fetchall()
+        if not rows:
+            break
+        refs = [(put_blob(map_html) if map_html.strip() != '' else None, user_id) for user_id, map_html in rows]
+        with pool.transaction() as conn:
+            conn.executemany("UPDATE user_data SET map_ref = ?, map_html = NULL WHERE id = ?", refs)
+        moved += len(rows)
+
+    if moved:
+        # Give the space the inline maps took back to the file system
+        with pool.connection() as conn:
+            conn.execute("VACUUM")
+        if debug:
+            print(f"Moved {moved} saved maps to the blob store")
+    return moved
+
+def expire_maps(ttl_days=None):
+    # Forgets the saved map of sessions past the TTL and deletes every blob
+    # no session points at anymore. Returns (sessions expired, blobs removed).
+    ttl_days = map_ttl_days if ttl_days is None else ttl_days
+    with pool.transaction() as conn:
+        expired = conn.execute("UPDATE user_data SET map_ref = NULL WHERE map_ref IS NOT NULL AND last_accessed < ?", (ttl_cutoff(ttl_days),)).rowcount
+        live_refs = [row[0] for row in conn.execute("SELECT DISTINCT map_ref FROM user_data WHERE map_ref IS NOT NULL")]
+    removed = collect_blobs(live_refs)
 
-def check_id_exists(user_id):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
+    if debug:
+        print(f"Expired maps of {expired} sessions, removed {removed} blobs")
+    return expired, removed
 
-    # Check if the ID exists in the database
-    cursor.execute("SELECT COUNT(*) FROM user_data WHERE id = ?", (user_id,))
-    count = cursor.fetchone()[0]
+def evict_sessions(ttl_days=None):
+    # Deletes sessions not seen for longer than the TTL, returns how many.
+    # Their blobs are collected on the next expire_maps().
+    ttl_days = session_ttl_days if ttl_days is None else ttl_days
+    with pool.transaction() as conn:
+        evicted = conn.execute("DELETE FROM user_data WHERE last_accessed < ?", (ttl_cutoff(ttl_days),)).rowcount
 
-    conn.close()
+    if debug:
+        print(f"Evicted {evicted} sessions older than {ttl_days} days")
+    return evicted
+
+def ttl_cutoff(ttl_days):
+    return (datetime.now(timezone.utc) - timedelta(days=ttl_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+class SessionJanitor:
+    # Background thread evicting stale sessions and their saved maps every
+    # interval seconds, starting with a sweep as soon as it is started
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.runs = 0
+        self.sessions_evicted = 0
+        self.maps_expired = 0
+        self.blobs_removed = 0
+        self.last_run = None
+        self.last_error = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._thread = threading.Thread(target=self._loop, name='session-janitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        evicted = evict_sessions()
+        expired, removed = expire_maps()
+        with self._lock:
+            self.runs += 1
+            self.sessions_evicted += evicted
+            self.maps_expired += expired
+            self.blobs_removed += removed
+            self.last_run = current_time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'lastRun': self.last_run,
+                'lastError': self.last_error,
+                'sessionsEvicted': self.sessions_evicted,
+                'mapsExpired': self.maps_expired,
+                'blobsRemoved': self.blobs_removed,
+                'intervalSeconds': self.interval,
+                'sessionTtlDays': session_ttl_days,
+                'mapTtlDays': map_ttl_days,
+            }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                # Keep going, the next run may well succeed
+                print(f"Session janitor failed: {e}")
+                with self._lock:
+                    self.last_error = str(e)
+            self._stop.wait(self.interval)
+
+janitor = SessionJanitor(janitor_interval)
+
+def session_stats():
+    # Size of the session table plus what the janitor has done so far
+    with pool.connection() as conn:
+        sessions = conn.execute("SELECT COUNT(*) FROM user_data").fetchone()[0]
+        with_map = conn.execute("SELECT COUNT(map_ref) FROM user_data").fetchone()[0]
+        next_id = conn.execute("SELECT seq + 1 FROM sqlite_sequence WHERE name = 'user_data'").fetchone()
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        'sessions': sessions,
+        'sessionsWithMap': with_map,
+        'nextId': next_id[0] if next_id else 1,
+        'dbBytes': page_count * page_size,
+        'janitor': janitor.stats(),
+    }
+
+def migrate_database():
+    # Creates or upgrades the tables, then moves maps saved before the blob
+    # store out of the database. Run once by the serving process at startup,
+    # not on import, as the move ends with a VACUUM.
+    create_tables()
+    move_inline_maps()
+
+def current_time():
+    # UTC, the same as the CURRENT_TIMESTAMP default of last_accessed, so
+    # the janitor compares like with like
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def check_id_exists(user_id):
+    # Check if the ID exists in the database
+    with pool.connection() as conn:
+        exists = conn.execute("SELECT 1 FROM user_data WHERE id = ?", (user_id,)).fetchone() is not None
 
     if debug:
-        if count > 0:
+        if exists:
             update_last_accessed(user_id)
             print(f"ID {user_id} exists in the database.")  # Debug print
 
-    return count > 0
+    return exists
+
+def open_session(user_id):
+    # A returning session: marks it as used and reads its map reference in
+    # one write transaction, so the janitor keeps the session and its saved
+    # map. Returns (exists, map_html or None).
+    with pool.transaction() as conn:
+        if not conn.execute("UPDATE user_data SET last_accessed = ? WHERE id = ?", (current_time(), user_id)).rowcount:
+            return False, None
+        map_ref = conn.execute("SELECT map_ref FROM user_data WHERE id = ?", (user_id,)).fetchone()[0]
+
+    if debug:
+        print(f"Last accessed time updated for ID {user_id}.")  # Debug print
+
+    return True, read_blob(map_ref)
+
+def get_map_ref(user_id):
+    with pool.connection() as conn:
+        result = conn.execute("SELECT map_ref FROM user_data WHERE id = ?", (user_id,)).fetchone()
+    return result[0] if result is not None else None
 
 def check_map_html_exists(user_id):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    # SQL query to select map_html for a specific id
-    cursor.execute("SELECT map_html FROM user_data WHERE id = ?", (user_id,))
-    result = cursor.fetchone()
-
-    if result is not None and result[0] is not None and result[0].strip() != '':
-        # map_html exists and is not empty
-        conn.close()
-        return True
-    else:
-        # map_html does not exist or is empty
-        conn.close()
-        return False
-    
+    # Only the reference is read, the map itself stays on disk
+    return blob_exists(get_map_ref(user_id))
+
 def get_map_html(user_id):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    # SQL query to select map_html for a specific id
-    cursor.execute("SELECT map_html FROM user_data WHERE id = ?", (user_id,))
-    result = cursor.fetchone()
+    # Return map_html content if it exists
+    return read_blob(get_map_ref(user_id))
 
-    if result is not None and result[0] is not None:
-        conn.close()
-        return result[0]  # Return map_html content if it exists
-    else:
-        conn.close()
+def store_map_html(map_html):
+    # Reference to save in the row, None for no map
+    if map_html is None or map_html.strip() == '':
         return None
-    
+    return put_blob(map_html)
+
 def update_map_html(user_id, new_map_html):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    # SQL query to update map_html for a specific id
-    cursor.execute("UPDATE user_data SET map_html = ? WHERE id = ?", (new_map_html, user_id))
-    conn.commit()
-    conn.close()
+    map_ref = store_map_html(new_map_html)
+    with pool.transaction() as conn:
+        conn.execute("UPDATE user_data SET map_ref = ? WHERE id = ?", (map_ref, user_id))
 
 def update_data_set(user_id, data_set):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    # SQL query to update map_html for a specific id
-    cursor.execute("UPDATE user_data SET data_set = ? WHERE id = ?", (data_set, user_id))
-    conn.commit()
-    conn.close()
+    with pool.transaction() as conn:
+        conn.execute("UPDATE user_data SET data_set = ? WHERE id = ?", (data_set, user_id))
 
 def update_last_accessed(user_id):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-
     # Update the last_accessed time for the given user_id
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute("UPDATE user_data SET last_accessed = ? WHERE id = ?", (current_time, user_id))
-    conn.commit()
-
-    conn.close()
+    with pool.transaction() as conn:
+        conn.execute("UPDATE user_data SET last_accessed = ? WHERE id = ?", (current_time(), user_id))
 
     if debug:
         print(f"Last accessed time updated for ID {user_id}.")  # Debug print
 
 def check_if_name_exists(name):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    
     # Check if the name exists in the database
-    cursor.execute("SELECT COUNT(*) FROM user_data WHERE name = ?", (name,))
-    count = cursor.fetchone()[0]
-    
-    conn.close()
-    
+    with pool.connection() as conn:
+        exists = conn.execute("SELECT 1 FROM user_data WHERE name = ?", (name,)).fetchone() is not None
+
     if debug:
-        if count > 0:
+        if exists:
             print(f"Name '{name}' exists in the database.")  # Debug print
 
-    return count > 0
+    return exists
 
 def insert_user_data(name, years, islands, months, map_data, data_set, last_accesed):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    
-    # Check if the name already exists
-    if not check_if_name_exists(name):
-        cursor.execute("INSERT INTO user_data (name, years, islands, months, data_set, map_html, last_accessed) VALUES (?, ?, ?, ?, ?, ?, ?)", (name, years, islands, months, map_data, data_set, last_accesed))
-        conn.commit()
+    map_ref = store_map_html(map_data)
+    with pool.transaction() as conn:
+        # Check if the name already exists
+        if conn.execute("SELECT 1 FROM user_data WHERE name = ?", (name,)).fetchone() is None:
+            conn.execute("INSERT INTO user_data (name, years, islands, months, data_set, map_ref, last_accessed) VALUES (?, ?, ?, ?, ?, ?, ?)", (name, years, islands, months, data_set, map_ref, last_accesed))
+            inserted = True
+        else:
+            inserted = False
+
+    if inserted:
         print(f"Inserted data for {name}")
     else:
         print(f"Name '{name}' already exists in the database. Skipping insertion.")
-    
-    conn.close()
 
 def insert_entry_with_checked_id():
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-
-    # Find the first available ID that isn't in use
-    cursor.execute("SELECT id + 1 FROM user_data WHERE NOT EXISTS (SELECT 1 FROM user_data AS t2 WHERE t2.id = user_data.id + 1) ORDER BY id LIMIT 1")
-    available_id = cursor.fetchone()
-
-    if available_id:
-        available_id = available_id[0]
-        cursor.execute("INSERT INTO user_data (id) VALUES (?)", (available_id,))
-        conn.commit()
-        
-        if debug:
-            print(f"Inserted entry with ID {available_id}")  # Debug print
-    else:
-        # If no gaps found, insert at the end
-        cursor.execute("INSERT INTO user_data DEFAULT VALUES")
-        available_id = cursor.lastrowid
-        conn.commit()
+    # AUTOINCREMENT hands out the next ID from sqlite_sequence, no scan of
+    # the table and an evicted session's ID is never given to someone else
+    with pool.transaction() as conn:
+        available_id = conn.execute("INSERT INTO user_data (last_accessed) VALUES (?)", (current_time(),)).lastrowid
+
+    if debug:
+        print(f"Inserted entry with ID {available_id}")  # Debug print
 
-    conn.close()
     return available_id
 
 def update_user_data_name(name, new_years, new_islands, new_months):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-
-    # Check if the name exists in the database
-    cursor.execute("SELECT COUNT(*) FROM user_data WHERE name = ?", (name,))
-    count = cursor.fetchone()[0]
-
-    if count > 0:
+    with pool.transaction() as conn:
         # Update years, islands, and months for the provided name
-        cursor.execute("UPDATE user_data SET years = ?, islands = ?, months = ? WHERE name = ?", (new_years, new_islands, new_months, name))
-        conn.commit()
-        
-        if debug:
+        updated = conn.execute("UPDATE user_data SET years = ?, islands = ?, months = ? WHERE name = ?", (new_years, new_islands, new_months, name)).rowcount
+
+    if debug:
+        if updated:
             print(f"User data for '{name}' updated: Years - {new_years}, Islands - {new_islands}, Months - {new_months}")  # Debug print
-    else:
-        if debug:
+        else:
             print(f"No entries found with the name '{name}'. No updates performed.")
 
-    conn.close()
-
 def update_user_data_id(user_id, new_years, new_islands, new_months, map_data, new_data_set):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
+    # The whole state of a map request is written in one statement and one
+    # commit, an unknown ID simply updates nothing. The map goes to the blob
+    # store first so the transaction only holds a short reference.
+    map_ref = store_map_html(map_data)
+    with pool.transaction() as conn:
+        updated = conn.execute("UPDATE user_data SET years = ?, islands = ?, months = ?, map_ref = ?, data_set = ?, last_accessed = ? WHERE id = ?",
+                               (new_years, new_islands, new_months, map_ref, new_data_set, current_time(), user_id)).rowcount
 
-    update_last_accessed(user_id)
-    update_map_html(user_id, map_data)
-    update_data_set(user_id, new_data_set)
-    # Check if the ID exists in the database
-    cursor.execute("SELECT COUNT(*) FROM user_data WHERE id = ?", (user_id,))
-    count = cursor.fetchone()[0]
-
-    if count > 0:
-        # Update years, islands, and months for the provided ID
-        cursor.execute("UPDATE user_data SET years = ?, islands = ?, months = ?, data_set = ? WHERE id = ?", (new_years, new_islands, new_months, new_data_set, user_id))
-        conn.commit()
-        
-        if debug:
+    if debug:
+        if updated:
             print(f"User data for ID '{user_id}' updated: Years - {new_years}, Islands - {new_islands}, Months - {new_months}, Data Set - {new_data_set}")  # Print updated info
-    else:
-        if debug:
+        else:
             print(f"No entries found with the ID '{user_id}'. No updates performed.")
 
-    conn.close()
-
 def print_all_entries():
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-
     # Fetch all entries from user_data table
-    cursor.execute("SELECT * FROM user_data")
-    rows = cursor.fetchall()
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT * FROM user_data").fetchall()
 
     # Print all entries
     if debug:
         for row in rows:
             print(row)  # Debug print
 
-    conn.close()
-
 def delete_entry_by_name(name):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-
-    # Check if the name exists in the database
-    cursor.execute("SELECT COUNT(*) FROM user_data WHERE name = ?", (name,))
-    count = cursor.fetchone()[0]
-
-    if count > 0:
+    with pool.transaction() as conn:
         # Delete entries with the provided name
-        cursor.execute("DELETE FROM user_data WHERE name = ?", (name,))
-        conn.commit()
-        
-        if debug:
+        deleted = conn.execute("DELETE FROM user_data WHERE name = ?", (name,)).rowcount
+
+    if debug:
+        if deleted:
             print(f"All entries with the name '{name}' have been deleted.")  # Debug print
-    else:
-        if debug:
+        else:
             print(f"No entries found with the name '{name}'. No deletions performed.")
 
-    conn.close()
-
-def get_values_by_id(user_id):
-    conn = sqlite3.connect('fire_users.db')
-    cursor = conn.cursor()
-    update_last_accessed(user_id)
-
-    # Retrieve specific columns based on the provided ID
-    cursor.execute("SELECT id, name, years, islands, months, data_set, last_accessed FROM user_data WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-
-    conn.close()
+def get_values_by_id(user_id, touch=False):
+    # Read only unless touch is set, then the session is also marked as
+    # used in the same write transaction
+    query = "SELECT id, name, years, islands, months, data_set, last_accessed FROM user_data WHERE id = ?"
+    if touch:
+        with pool.transaction() as conn:
+            conn.execute("UPDATE user_data SET last_accessed = ? WHERE id = ?", (current_time(), user_id))
+            row = conn.execute(query, (user_id,)).fetchone()
+    else:
+        with pool.connection() as conn:
+            row = conn.execute(query, (user_id,)).fetchone()
 
     if debug:
         if row:
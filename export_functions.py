@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+from dataset_cache import dataset_cache, is_derived_file, source_mtime
+from map_cache import make_key
+
+# Set debug flag
+debug = False
+
+# Finished exports are kept under <export_cache_dir>/<data set>/<key>.<ext>
+# so the same selection is only written once
+export_cache_dir = os.path.join('output', 'export_cache')
+
+# Read size for files copied into a streamed zip
+zip_chunk_bytes = 1024 * 1024
+
+# Disk budget for cached exports, override with EXPORT_CACHE_MB
+max_export_cache_bytes = int(os.environ.get('EXPORT_CACHE_MB', 1024)) * 1024 * 1024
+
+# Exports written or handed out more recently than this are never trimmed,
+# a request may have picked one and not opened it yet
+trim_grace_seconds = 60
+
+def write_shapefile_zip(gdf, path, layer):
+    # The shapefile parts are written to a private temp folder and copied
+    # into the zip in chunks, so memory use doesn't grow with the export
+    with tempfile.TemporaryDirectory(prefix='export_') as folder:
+        gdf.to_file(os.path.join(folder, layer + '.shp'), driver='ESRI Shapefile')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for name in sorted(os.listdir(folder)):
+                zipf.write(os.path.join(folder, name), name)
+
+def write_geopackage(gdf, path, layer):
+    gdf.to_file(path, driver='GPKG', layer=layer)
+
+def write_geoparquet(gdf, path, layer):
+    gdf.to_parquet(path)
+
+def write_flatgeobuf(gdf, path, layer):
+    # Comes with a spatial index so clients can read just the area they need
+    gdf.to_file(path, driver='FlatGeobuf', layer=layer, SPATIAL_INDEX='YES')
+
+def write_geojson_seq(gdf, path, layer):
+    # One feature per record (RFC 8142), readable while still downloading
+    gdf.to_file(path, driver='GeoJSONSeq', RS='YES')
+
+def write_csv_wkt(gdf, path, layer):
+    gdf.to_file(path, driver='CSV', GEOMETRY='AS_WKT')
+
+# Format name -> (file extension, mimetype, writer). Every writer streams
+# features to disk, the finished file is then streamed to the client.
+export_formats = {
+    'shp': ('zip', 'application/zip', write_shapefile_zip),
+    'gpkg': ('gpkg', 'application/geopackage+sqlite3', write_geopackage),
+    'parquet': ('parquet', 'application/vnd.apache.parquet', write_geoparquet),
+    'fgb': ('fgb', 'application/flatgeobuf', write_flatgeobuf),
+    'geojsonseq': ('geojsons', 'application/geo+json-seq', write_geojson_seq),
+    'csv': ('csv', 'text/csv', write_csv_wkt),
+}
+
+class ExportStats:
+    # Export counts, sizes and write speed per format, to compare formats
+    # for field teams on slow links
+
+    def __init__(self):
+        self._formats = {}
+        self._lock = threading.Lock()
+
+    def record(self, fmt, size, seconds, cached):
+        with self._lock:
+            stats = self._formats.setdefault(fmt, {'written': 0, 'cacheHits': 0, 'bytesWritten': 0, 'writeSeconds': 0.0})
+            if cached:
+                stats['cacheHits'] += 1
+            else:
+                stats['written'] += 1
+                stats['bytesWritten'] += size
+                stats['writeSeconds'] += seconds
+
+    def stats(self):
+        with self._lock:
+            formats = {}
+            for fmt, stats in self._formats.items():
+                seconds = stats['writeSeconds']
+                formats[fmt] = dict(stats,
+                                    writeSeconds=round(seconds, 4),
+                                    averageBytes=stats['bytesWritten'] // stats['written'] if stats['written'] else 0,
+                                    bytesPerSecond=round(stats['bytesWritten'] / seconds) if seconds else 0)
+            return formats
+
+export_stats = ExportStats()
+
+def export_path(data_set, key, fmt):
+    return os.path.join(export_cache_dir, data_set, f'{key}.{export_formats[fmt][0]}')
+
+def get_export(data_set, years, months, islands, fmt='shp'):
+    # Returns (path, etag, mimetype) of the export of a selection, writing it
+    # first if this selection hasn't been exported since the last upload
+    key = make_key(data_set, source_mtime(data_set), years, months, islands, extra={'format': fmt})
+    path = export_path(data_set, key, fmt)
+    _, mimetype, writer = export_formats[fmt]
+
+    try:
+        # Mark as recently used, which also keeps it from being trimmed
+        # while the caller opens it
+        os.utime(path)
+        cached = True
+    except FileNotFoundError:
+        cached = False
+
+    if cached:
+        export_stats.record(fmt, 0, 0.0, cached=True)
+    else:
+        start = time.perf_counter()
+        # Downloads keep the projection the data set was uploaded in
+        gdf = dataset_cache.query(data_set, years, months, islands, variant='source')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Hidden until complete, some drivers pick their layout from the
+        # extension so it is kept at the end
+        temp_path = os.path.join(os.path.dirname(path), f'.{threading.get_ident()}.{os.path.basename(path)}')
+        try:
+            writer(gdf, temp_path, data_set)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        export_stats.record(fmt, os.path.getsize(path), time.perf_counter() - start, cached=False)
+        if debug:
+            print(f"Exported {len(gdf)} fires of '{data_set}' to {path}")
+        trim_exports()
+
+    return path, key[:32], mimetype
+
+def trim_exports(max_bytes=None):
+    # Deletes the least recently used exports until the cache fits its budget
+    max_bytes = max_export_cache_bytes if max_bytes is None else max_bytes
+    cutoff = time.time() - trim_grace_seconds
+    found = []
+    if not os.path.isdir(export_cache_dir):
+        return
+    for data_set in os.scandir(export_cache_dir):
+        if data_set.is_dir():
+            for entry in os.scandir(data_set.path):
+                if not entry.name.startswith('.') and entry.is_file():
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.path, stat.st_size))
+
+    total = sum(size for _, _, size in found)
+    # Keep the newest export even when it alone is over budget
+    for mtime, path, size in sorted(found)[:-1]:
+        if total <= max_bytes or mtime >= cutoff:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+def invalidate_exports(data_set):
+    shutil.rmtree(os.path.join(export_cache_dir, data_set), ignore_errors=True)
+
+class ZipStreamSink:
+    # Write-only file object for zipfile. It has no seek, so zipfile writes
+    # sizes after each entry instead of going back to patch headers, and
+    # the bytes written so far can be handed out and dropped.
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def zip_members(paths):
+    # (file path, name in the zip) for each path, folders are walked.
+    # Index and map copy sidecars are left out.
+    for path in paths:
+        if is_derived_file(path):
+            continue
+        if os.path.isdir(path):
+            parent = os.path.dirname(path)
+            for root, _, files in os.walk(path):
+                for file in sorted(files):
+                    if is_derived_file(file):
+                        continue
+                    file_path = os.path.join(root, file)
+                    yield file_path, os.path.relpath(file_path, parent)
+        elif os.path.isfile(path):
+            yield path, os.path.basename(path)
+
+def stream_zip(paths, chunk_bytes=None):
+    # Yields a zip of the given files piece by piece. At most one chunk of
+    # one file is held in memory at a time, nothing is written to disk.
+    chunk_bytes = zip_chunk_bytes if chunk_bytes is None else chunk_bytes
+    sink = ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for file_path, arcname in zip_members(paths):
+            # from_file records the size, so big files get zip64 headers
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+            with open(file_path, 'rb') as source, zipf.open(zinfo, 'w') as target:
+                while True:
+                    chunk = source.read(chunk_bytes)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    yield sink.take()
+            yield sink.take()
+    # Central directory
+    yield sink.take()
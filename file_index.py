@@ -0,0 +1,150 @@
+import os
+import threading
+from datetime import datetime
+
+# Set debug flag
+debug = False
+
+def format_mtime(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+class FileIndex:
+    # Sizes, modification dates and folder contents of everything under
+    # root, gathered in one os.scandir pass. Folder sizes are summed from
+    # their children as the scan returns. Uploads and deletes update only
+    # the path they touched, a change to root made elsewhere (seen from its
+    # mtime) triggers a new full scan.
+
+    def __init__(self, root):
+        self.root = root
+        # Path relative to root ('' for root) -> node
+        self._nodes = {}
+        self._root_mtime = None
+        self._scans = 0
+        self._updates = 0
+        self._lock = threading.Lock()
+
+    def _scan(self, rel, entry=None):
+        # Adds the node at rel and everything below it, returns its size
+        path = os.path.join(self.root, rel) if rel else self.root
+        stat = entry.stat(follow_symlinks=False) if entry is not None else os.stat(path, follow_symlinks=False)
+        is_dir = entry.is_dir(follow_symlinks=False) if entry is not None else os.path.isdir(path)
+        node = {'name': os.path.basename(rel), 'isDir': is_dir, 'modDate': format_mtime(stat.st_mtime)}
+
+        if is_dir:
+            children = []
+            size = 0
+            with os.scandir(path) as entries:
+                for child in entries:
+                    children.append(child.name)
+                    size += self._scan(os.path.join(rel, child.name) if rel else child.name, child)
+            node['children'] = sorted(children)
+            node['size'] = size
+        else:
+            node['size'] = stat.st_size
+
+        self._nodes[rel] = node
+        return node['size']
+
+    def _drop(self, rel):
+        node = self._nodes.pop(rel, None)
+        if node is not None and node['isDir']:
+            for child in node['children']:
+                self._drop(os.path.join(rel, child))
+
+    def rebuild(self):
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._nodes = {}
+        self._root_mtime = os.stat(self.root).st_mtime_ns
+        self._scan('')
+        self._scans += 1
+        if debug:
+            print(f"Indexed {len(self._nodes)} paths under {self.root}")
+
+    def _check(self):
+        if self._root_mtime != os.stat(self.root).st_mtime_ns:
+            self._rebuild()
+
+    def update(self, rel):
+        # Rescans one path after it was added, replaced or removed and
+        # corrects the sizes of the folders above it
+        rel = os.path.normpath(rel).strip(os.sep)
+        if rel in ('', '.') or rel.startswith('..'):
+            return
+        with self._lock:
+            parent_rel = os.path.dirname(rel)
+            parent = self._nodes.get(parent_rel)
+            if not self._nodes or parent is None:
+                self._rebuild()
+                return
+
+            old_size = self._nodes[rel]['size'] if rel in self._nodes else 0
+            self._drop(rel)
+            name = os.path.basename(rel)
+            if os.path.lexists(os.path.join(self.root, rel)):
+                new_size = self._scan(rel)
+                if name not in parent['children']:
+                    parent['children'] = sorted(parent['children'] + [name])
+            else:
+                new_size = 0
+                if name in parent['children']:
+                    parent['children'] = [child for child in parent['children'] if child != name]
+
+            # Sizes and dates of every folder up to root
+            while True:
+                node = self._nodes[parent_rel]
+                node['size'] += new_size - old_size
+                node['modDate'] = format_mtime(os.stat(os.path.join(self.root, parent_rel)).st_mtime)
+                if not parent_rel:
+                    break
+                parent_rel = os.path.dirname(parent_rel)
+            self._root_mtime = os.stat(self.root).st_mtime_ns
+            self._updates += 1
+
+    def _file_object(self, rel, depth):
+        node = self._nodes[rel]
+        file_object = {
+            'id': node['name'],
+            'name': node['name'],
+            'path': rel,
+            'isDir': node['isDir'],
+            'isHidden': node['isDir'],
+            'openable': False,
+            'files': [],
+            'size': node['size'],
+            'modDate': node['modDate'],
+        }
+        if node['isDir']:
+            file_object['childCount'] = len(node['children'])
+            # depth None lists everything, otherwise folders below it are
+            # left empty to be expanded on request
+            if depth is None or depth > 1:
+                file_object['files'] = [self._file_object(os.path.join(rel, child), None if depth is None else depth - 1)
+                                        for child in node['children']]
+        return file_object
+
+    def listing(self, rel='', depth=None, offset=0, limit=None):
+        # Returns (entries of the folder at rel, number of entries in it),
+        # (None, 0) if rel isn't a folder
+        rel = os.path.normpath(rel).strip(os.sep) if rel else ''
+        rel = '' if rel == '.' else rel
+        with self._lock:
+            self._check()
+            node = self._nodes.get(rel)
+            if node is None or not node['isDir']:
+                return None, 0
+            children = node['children']
+            page = children[offset:offset + limit] if limit is not None else children[offset:]
+            return [self._file_object(os.path.join(rel, child) if rel else child, depth) for child in page], len(children)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'paths': len(self._nodes),
+                'totalBytes': self._nodes[''].get('size', 0) if '' in self._nodes else 0,
+                'scans': self._scans,
+                'updates': self._updates,
+            }
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+# Set debug flag
+debug = False
+
+# Columns every filter selection is made over
+filter_columns = ('Year', 'FireMonth', 'Island')
+
+def split_selection(selection):
+    # Accepts the raw request list (['2021,2022']), a stored string
+    # ('2021,2022') or an already split list and returns the selected values.
+    # None means nothing was selected, which selects everything.
+    if selection is None:
+        return None
+    if isinstance(selection, str):
+        selection = [selection]
+
+    values = []
+    for item in selection:
+        if item is None:
+            continue
+        values.extend(value.strip() for value in str(item).split(','))
+
+    values = [value for value in values if value != '']
+    return values if values else None
+
+def categorize_columns(gdf):
+    # Categorical filter columns turn every isin into a lookup on the
+    # handful of distinct values instead of a string compare per row
+    for column in filter_columns:
+        if column in gdf.columns and not isinstance(gdf[column].dtype, pd.CategoricalDtype):
+            gdf[column] = gdf[column].astype('category')
+    return gdf
+
+def column_mask(series, values):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories.astype(str)
+        wanted = np.flatnonzero(categories.isin(values))
+        return np.isin(series.cat.codes.to_numpy(), wanted)
+    return series.astype(str).isin(values).to_numpy()
+
+def filter_mask(gdf, years, months, islands):
+    mask = np.ones(len(gdf), dtype=bool)
+    for column, selection in zip(filter_columns, (years, months, islands)):
+        values = split_selection(selection)
+        if values is not None:
+            mask &= column_mask(gdf[column], values)
+    return mask
+
+def filter_geo_data(gdf, years, months, islands):
+    if debug:
+        print(f"These are the filtered years: {split_selection(years)}")
+        print(f"These are the filtered months: {split_selection(months)}")
+        print(f"These are the filtered islands: {split_selection(islands)}")
+
+    # Exact matches on each selected column, an empty selection keeps all rows
+    return gdf[filter_mask(gdf, years, months, islands)].copy()
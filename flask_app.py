@@ -1,23 +1,28 @@
 import os
-import io
 import base64
-import geopandas as gpd
-import pyproj
 import folium
 import math
-import zipfile
 import shutil
+import threading
 import jwt
 import sqlite3
 import bcrypt
 from datetime import datetime, timedelta
 from palettable.colorbrewer.qualitative import Set3_12
-from flask import Flask, jsonify, send_file, request, send_from_directory
-from shapely.geometry import Polygon, MultiPolygon
-from folium.plugins import MarkerCluster
+from flask import Flask, jsonify, send_file, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 from db_functions import*
-from collections import defaultdict
+from dataset_cache import dataset_cache, source_mtime
+from map_cache import make_key, map_cache
+from vector_functions import features_geojson, gzip_bytes
+from tile_functions import get_tile, invalidate_tiles, tile_index, valid_tile
+from projection_functions import derived_columns
+from marker_functions import add_fire_markers
+from export_functions import export_formats, export_stats, get_export, invalidate_exports, stream_zip
+from stats_functions import burn_stats, cached_burn_stats, cube_breakdown, cube_summary, delete_cube, json_number
+from ingest_functions import IngestQueue, get_job, ingest_workers
+from catalog_functions import DataCatalog, catalog_poll_seconds
+from file_index import FileIndex
 
 # User directory
 user_dir = os.path.expanduser('~')
@@ -27,6 +32,51 @@ debug = False
 app = Flask(__name__)
 CORS(app)
 
+def ingest_done(data_set):
+    # Drop any parsed copy, rendered map, tile or export made from the data
+    # set as it was before the worker rewrote it
+    dataset_cache.invalidate(data_set)
+    map_cache.invalidate(data_set)
+    invalidate_tiles(data_set)
+    invalidate_exports(data_set)
+    # Lists the data set once its job has registered it
+    catalog.refresh()
+    # Folder the archive was extracted to
+    file_index.update(data_set)
+
+# Sizes and dates of everything under ExampleFiles for the file manager
+file_index = FileIndex('ExampleFiles')
+
+# Uploaded archives are validated, extracted and indexed in worker processes
+ingest_queue = IngestQueue(ingest_workers, on_done=ingest_done)
+
+# Data sets and their years, islands and months for /api/list, archives
+# dropped into the data folder are queued for ingest by its watcher
+catalog = DataCatalog(catalog_poll_seconds, on_archive=ingest_queue.submit)
+
+# The session database is migrated and background services are started
+# by the first request, so they only run in the process serving the app. The reloader's watching process of
+# app.run(debug=True) and the ingest workers, which import this module
+# again as __mp_main__, never serve one.
+services_started = False
+services_lock = threading.Lock()
+
+@app.before_request
+def start_services():
+    global services_started
+    if services_started:
+        return
+    with services_lock:
+        if services_started:
+            return
+        migrate_database()
+        # Evicts stale sessions and their saved maps in the background
+        janitor.start()
+        # Jobs left over from a previous run are marked as failed
+        ingest_queue.start()
+        catalog.start()
+        services_started = True
+
 file_name = 'key.txt'
 try:
     with open(file_name, 'r') as file:
@@ -35,33 +85,6 @@ except FileNotFoundError:
     print(f"The file '{file_name}' was not found.")
 
 app.config['SECRET_KEY'] = key_string
-def read_prj_file(file_path):
-    try:
-        with open(file_path, 'r') as prj_file:
-            prj_content = prj_file.read()
-            return prj_content
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-
-def create_user_folder(folder_path):
-    if not os.path.exists(folder_path):
-        try:
-            os.makedirs(folder_path)
-            if debug:
-                print(f"Folder '{folder_path}' created successfully.")
-        except OSError as e:
-            if debug:
-                print(f"Error creating folder: {e}")
-    else:
-        print(f"Folder '{folder_path}' already exists.")
-
-# Function to securely create a new user
-def create_user(username, password):
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-    conn.commit()
-
 # Function to authenticate a user
 def authenticate_user(username, password):
         # Connect to SQLite database
@@ -77,81 +100,6 @@ def authenticate_user(username, password):
             return True
     return False
 
-# Function to search for zip files in a folder
-def find_zip_files(folder_path):
-    return [os.path.join(root, file) for root, _, files in os.walk(folder_path) for file in files if file.endswith('.zip')]
-
-# Function to check if a file has been unzipped
-def check_unzipped(file_path):
-    unzip_folder = os.path.splitext(file_path)[0]  # Extract folder name without the .zip extension
-    return os.path.exists(unzip_folder)
-
-def sort_months(arr):
-    months = [
-        'January', 'February', 'March', 'April', 'May', 'June',
-        'July', 'August', 'September', 'October', 'November', 'December'
-    ]
-
-    only_months = sorted([month for month in arr if month in months], key=lambda x: months.index(x))
-    other_items = [item for item in arr if item not in months]
-
-    return only_months + other_items
-
-# Function to process shapefile and retrieve required information
-def process_shapefile(shapefile_path):
-    gdf_total = gpd.read_file(shapefile_path)
-    unique_months = list(gdf_total['FireMonth'].unique())
-    sorted_months = sort_months(unique_months)
-    all_islands = ','.join(map(str, list(gdf_total['Island'].unique())))
-    all_years = ','.join(map(str, sorted(list(gdf_total['Year'].unique()))))
-    unique_months_str = ','.join(map(str, sorted_months))
-    return all_islands, all_years, unique_months_str
-
-# Function to unzip a file, process shapefile, and update SQLite DB
-def unzip_and_update_db(zip_file, db_connection):
-    try:
-        unzip_folder = os.path.splitext(zip_file)[0]
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            zip_ref.extractall(path=os.path.dirname(zip_file))
-
-        shp_file = '/'+os.path.splitext(unzip_folder.split('/')[-1])[0] + '.shp'
-        shp_path = unzip_folder+shp_file
-        if debug:
-            print(f"This is the sph_path: {shp_path}")
-        if os.path.exists(shp_path):
-            all_islands, all_years, sorted_months = process_shapefile(shp_path)
-            cursor = db_connection.cursor()
-            cursor.execute("INSERT OR IGNORE INTO files (file_name, unzipped, total_islands, total_years, unique_months_str) VALUES (?, ?, ?, ?, ?)",
-                           (os.path.splitext(os.path.basename(zip_file))[0], 1, all_islands, all_years, sorted_months))
-            db_connection.commit()
-            cursor.close()
-        else:
-            print(f"No shapefile found in '{os.path.basename(zip_file)}'. Skipping database update.")
-    except Exception as e:
-        print(f"Error unzipping '{os.path.basename(zip_file)}': {e}")
-
-def transform_coordinates(geometry, proj):
-    if isinstance(geometry, Polygon):
-        projected_coords = []
-        for coords in geometry.exterior.coords:
-            projected_coords.append(proj(coords[0], coords[1], inverse=True))
-        return Polygon(projected_coords)
-    elif isinstance(geometry, MultiPolygon):
-        transformed_polygons = []
-        for polygon in geometry:
-            projected_coords = []
-            for coords in polygon.exterior.coords:
-                projected_coords.append(proj(coords[0], coords[1], inverse=True))
-            transformed_polygons.append(Polygon(projected_coords))
-        return MultiPolygon(transformed_polygons)
-    else:
-        raise ValueError("Unsupported geometry type")
-
-def drop_multipolygons(gdf):
-    # Use apply() to filter out rows with MultiPolygons
-    gdf = gdf[gdf['geometry'].apply(lambda geom: geom.geom_type == 'Polygon')]
-    return gdf
-
 def convert_months(months_list):
     # Check if the input list is not empty
     if months_list and len(months_list) == 1:
@@ -178,142 +126,12 @@ def convert_islands(island_list):
     else:
         return []
 
-def filter_geo_data(gdf, years, months, islands):
-    filtered_rows = []
-
-    #if nothing is selected choose all
-    if years == ['']:
-        years = list(gdf['Year'].unique())
-    if months == ['']:
-        months = list(gdf['FireMonth'].unique())
-    if islands == ['']:
-        islands = list(gdf['Island'].unique())
-
-    if debug:
-        print(f"These are the filtered years: {years}")
-        print(f"These are the filtered months: {months}")
-        print(f"These are the filtered islands: {islands}")
-
-    # Iterate over rows of the GeoDataFrame
-    for index, row in gdf.iterrows():
-        if row['Year'] in str(years) and row['FireMonth'] in months and row['Island'] in islands:
-            filtered_rows.append(row)
-
-    if not filtered_rows:
-        return gpd.GeoDataFrame(columns=gdf.columns, crs=gdf.crs)
-    else:
-        # Convert the list of filtered rows back to a GeoDataFrame
-        filtered_gdf = gpd.GeoDataFrame(filtered_rows, crs=gdf.crs, geometry='geometry')
-
-        return filtered_gdf
-
-# Define a function to categorize acreage into groups
-def categorize_acreage(acreage):
-    if acreage <= 0.25:
-        return '0-0.25'
-    elif 0.26 <= acreage <= 9.99:
-        return '0.26-9'
-    elif 10.0 <= acreage <= 99.99:
-        return '10-99'
-    elif 100.0 <= acreage <= 299.99:
-        return '100-299'
-    elif 300.0 <= acreage <= 999.99:
-        return '300-999'
-    elif 1000.0 <= acreage <= 9999.99:
-        return '1000-9999'
-    else:
-        return 'Undefined'
-
-@app.route('/api/data', methods=['GET'])
-def get_filtered_data():
-
-    #land area for islands to calculate % burn total
-    island_land_areas = {
-        'Tinian': 25010,  # Replace with actual land area in acres
-        'Saipan': 29400,  # Replace with actual land area in acres
-        'Rota': 21036.8,    # Replace with actual land area in acres
-        'Guam': 135700,   # Replace with actual land area in acres
-        'Palau': 113300,  # Replace with actual land area in acres
-        'Yap': 24710      # Replace with actual land area in acres
-    }
-
-    #set up dic for summary table
-    category_data = defaultdict(lambda: {'count': 0, 'acreage': 0.0})
-
-    # Retrieve query parameters for 'years' and 'islands'
-    years_get = request.args.getlist('years')
-    months_get = request.args.getlist('months')
-    islands_get = request.args.getlist('islands')
-    id_get = request.args.get('id_num')
-    try:
-        dataSet_raw = request.args.getlist('dataSet')
-    except:
-        print("no dataset")
-
-    # Connect to SQLite data sets
-    conn = sqlite3.connect('data_sets.db')
-
-    # Create a cursor object to interact with the database
-    cursor = conn.cursor()
-
-    #select the first entry in the table to be the default
-    cursor.execute("SELECT file_name FROM files LIMIT 1")
-
-    files = cursor.fetchone()
-    files_formatted = files[0].strip()
-    files_clean = f'"{files_formatted}"'
-    print(files_clean)
-
-    conn.close()
-
-    default_dataSet = files_clean
-
-    if dataSet_raw ==[]:
-        dataSet_raw = [default_dataSet]
-
-    if debug:
-        print(f"These years sent from the frontend: {years_get}")
-        print(f"These months sent from the frontend: {months_get}")
-        print(f"These islands sent from the frontend: {islands_get}")
-        print(f"---This is the stored id in the frontend: {id_get}---")
-        print(f"---This is the stored dataSet in the frontend: {dataSet_raw}---")
-
-    id = int(id_get)
-
-    try:
-        dataSet_get = dataSet_raw[0][1:-1]
-        shapefile_path = "ExampleFiles/"+dataSet_get+"/"+dataSet_get+".shp"
-        prjfile_path = 'ExampleFiles/'+str(dataSet_get)+'/'+str(dataSet_get)+'.prj'
-    except:
-        shapefile_path = 'ExampleFiles/'+str(default_dataSet)+'/'+str(default_dataSet)+'.shp'
-        prjfile_path = 'ExampleFiles/'+str(default_dataSet)+'/'+str(default_dataSet)+'.prj'
-
-    #convert the list object to a commma seperated list
-    split_months = convert_months(months_get)
-    split_islands = convert_islands(islands_get)
-
-    gdf = gpd.read_file(shapefile_path)
-
-    # Call the drop_multipolygons function to remove MultiPolygons
-    gdf = drop_multipolygons(gdf)
-
-    #calculate total land area for selected islands
-    if split_islands == ['']:
-        split_islands = list(gdf['Island'].unique())
+# Zoom the rendered map opens at
+map_zoom = 10
 
-    available_islands = list(gdf['Island'].unique())
+def render_filtered_map(dataset, years, split_months, split_islands, zoom=None):
 
-    # Islands to filter
-    selected_islands = [island for island in split_islands if island in available_islands]
-
-
-    # Filtering the dictionary based on selected islands
-    filtered_areas = {island: area for island, area in island_land_areas.items() if island in selected_islands}
-
-    # Calculating the total land area of selected islands
-    total_land_area = sum(filtered_areas.values())
-
-    gdf = filter_geo_data(gdf, years_get, split_months, split_islands)
+    gdf = dataset_cache.query(dataset['name'], years, split_months, split_islands, zoom=zoom)
 
     # Convert 'Year' column to integer type if it's not already
     gdf['Year'] = gdf['Year'].astype(int)
@@ -322,72 +140,23 @@ def get_filtered_data():
     unique_years = sorted(list(gdf['Year'].unique()))
     year_colors = {year: Set3_12.hex_colors[i % len(Set3_12.hex_colors)] for i, year in enumerate(unique_years)}
 
-    # Define the original projection using the provided WKT format
-    original_proj_wkt = read_prj_file(prjfile_path)
-
-    # Create a Proj object from the provided WKT projection information
-    original_proj = pyproj.Proj(original_proj_wkt)
-    # Calculate centroid of the first polygon
-    first_polygon_centroid = gdf['geometry'].iloc[0].centroid
-    centroid_utm_x, centroid_utm_y = first_polygon_centroid.x, first_polygon_centroid.y
-    centroid_lat, centroid_lon = original_proj(centroid_utm_x, centroid_utm_y, inverse=True)
+    # The cached copy is already in WGS84 with centroids worked out at ingest
+    centroid_lons = gdf['centroid_lon'].to_numpy()
+    centroid_lats = gdf['centroid_lat'].to_numpy()
 
     # Create a map centered over the first polygon
     m = folium.Map(
-        location=[centroid_lon, centroid_lat],
-        zoom_start=10,
+        location=[centroid_lats[0], centroid_lons[0]],
+        zoom_start=map_zoom,
         tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
         attr='Esri World Imagery',
         )
 
-    # Create a MarkerCluster layer
-    marker_cluster = MarkerCluster().add_to(m)
-    # Get the centroid coordinates of each polygon and add them as markers
-    for idx, row in gdf.iterrows():
-        centroid = row['geometry'].centroid
-        centroid_utm_x, centroid_utm_y = centroid.x, centroid.y
-        centroid_lat, centroid_lon = original_proj(centroid_utm_x, centroid_utm_y, inverse=True)
-
-        # Get comments and area information
-        acerage = round(row['Acerage'],2)
-        fire_year = row['Year']
-        month = row['FireMonth']
-
-        acreage_category = categorize_acreage(acerage)
-
-        # Increment count and sum acres for the category
-        category_data[acreage_category]['count'] += 1
-        category_data[acreage_category]['acreage'] += acerage
-
-        # Create marker popup content with comments and area
-        popup_content = f'Acres: {acerage}\n'
-        popup_content += f'Year: {fire_year}\n'
-        popup_content += f'Month: {month}'
-
-        # Create an HTML table with the given data
-        table_html = f"""
-        <table style="border-collapse: collapse; width: 100px;">
-            <tr>
-                <td style="border: 1px solid black; padding: 8px;">Acres</td>
-                <td style="border: 1px solid black; padding: 8px;">{acerage}</td>
-            </tr>
-            <tr>
-                <td style="border: 1px solid black; padding: 8px;">Year</td>
-                <td style="border: 1px solid black; padding: 8px;">{fire_year}</td>
-            </tr>
-            <tr>
-                <td style="border: 1px solid black; padding: 8px;">Month</td>
-                <td style="border: 1px solid black; padding: 8px;">{month}</td>
-            </tr>
-        </table>
-        """
-        folium.Marker([centroid_lon, centroid_lat], popup=table_html).add_to(marker_cluster)
-
-    # Apply coordinate transformation to the 'geometry' column
-    gdf['geometry'] = gdf['geometry'].apply(lambda geom: transform_coordinates(geom, original_proj))
+    # Clustered markers at each fire's centroid, built in the browser
+    add_fire_markers(m, gdf)
 
     # Convert GeoDataFrame to GeoJSON
-    geojson_data = gdf.to_json()
+    geojson_data = gdf.drop(columns=derived_columns).to_json()
 
     # Add GeoJSON data to the map with fill color based on 'Year' column
     folium.GeoJson(
@@ -400,25 +169,15 @@ def get_filtered_data():
         }
     ).add_to(m)
 
-    # Sort the filtered data by categories using the categorize_acreage function
-    sorted_data = dict(
-        sorted(
-            category_data.items(),
-            key=lambda x: (
-                float(x[0].split('-')[0]) if x[0] != 'Undefined' else float('inf'),
-                categorize_acreage(float(x[0].split('-')[0])) if x[0] != 'Undefined' else float('inf'),
-            ),
-        )
-    )
-
-    # Calculate 'Total' row separately after sorting
-    total_count = sum(v['count'] for v in category_data.values())
-    total_acres = sum(v['acreage'] for v in category_data.values() if isinstance(v['acreage'], (int, float)) and not math.isnan(v['acreage']))
-
-    # Add 'Total' row back to the sorted data
-    sorted_data['Totals'] = {'count': total_count, 'acreage': total_acres}
+    # Size class table summed from the burn cube written at ingest
+    summary = cube_summary(dataset['name'], years, split_months, split_islands)
+    sorted_data = {row['sizeClass']: row for row in summary['sizeClasses']}
+    sorted_data['Totals'] = summary['totals']
 
-    percent_burned = str(round(((total_acres/total_land_area)*100),2))+"%"
+    if summary['percentBurned'] is None:
+        percent_burned = 'N/A'
+    else:
+        percent_burned = str(round(summary['percentBurned'],2))+"%"
 
     # Create the legend HTML content
     summary_legend_html = '''
@@ -480,21 +239,61 @@ def get_filtered_data():
     # Add the legend HTML content to the map
     m.get_root().html.add_child(folium.Element(legend_html))
 
-    #default map output
-    user_folder = 'output/user_maps/'+'user_'+str(id_get)
+    # Render the page straight to a string, same output as m.save() without
+    # a per-user temp folder that concurrent requests could clobber
+    map_data = m.get_root().render()
 
-    create_user_folder(user_folder)
-    map_save = user_folder+ '/'+ str(id_get)+'_filtered_map.html'
+    return map_data
 
-    #save the map to a temp folder
-    m.save(map_save)
+@app.route('/api/data', methods=['GET'])
+def get_filtered_data():
 
-    # Read the HTML file contents into a variable
-    with open(map_save, "r") as file:
-        map_data = file.read()
+    # Retrieve query parameters for 'years' and 'islands'
+    years_get = request.args.getlist('years')
+    months_get = request.args.getlist('months')
+    islands_get = request.args.getlist('islands')
+    id_get = request.args.get('id_num')
+    try:
+        dataSet_raw = request.args.getlist('dataSet')
+    except:
+        print("no dataset")
 
-    #delete the temp folder that holds the temp html file
-    shutil.rmtree(user_folder)
+    #the first data set in the catalog is the default
+    default_dataSet = f'"{catalog.default_data_set()}"'
+
+    if dataSet_raw ==[]:
+        dataSet_raw = [default_dataSet]
+
+    if debug:
+        print(f"These years sent from the frontend: {years_get}")
+        print(f"These months sent from the frontend: {months_get}")
+        print(f"These islands sent from the frontend: {islands_get}")
+        print(f"---This is the stored id in the frontend: {id_get}---")
+        print(f"---This is the stored dataSet in the frontend: {dataSet_raw}---")
+
+    id = int(id_get)
+
+    try:
+        dataSet_get = dataSet_raw[0][1:-1]
+    except:
+        dataSet_get = default_dataSet[1:-1]
+
+    #convert the list object to a commma seperated list
+    split_months = convert_months(months_get)
+    split_islands = convert_islands(islands_get)
+
+    # Zoom to draw simplified polygons at, the zoom the map opens at by default
+    zoom = request.args.get('zoom', default=map_zoom, type=int)
+
+    # Identical selections on the same data set share one rendered map
+    map_key = make_key(dataSet_get, source_mtime(dataSet_get), years_get, split_months, split_islands,
+                       extra={'zoom': zoom})
+    map_data = map_cache.get(dataSet_get, map_key)
+    if map_data is None:
+        # Parsed data set comes from the in-memory cache
+        dataset = dataset_cache.get(dataSet_get)
+        map_data = render_filtered_map(dataset, years_get, split_months, split_islands, zoom)
+        map_cache.put(dataSet_get, map_key, map_data)
 
     update_user_data_id(id, years_get[0], islands_get[0], months_get[0], map_data, dataSet_get)
     if debug:
@@ -504,102 +303,162 @@ def get_filtered_data():
         print(temp_values)
         print('-----------------------------------------------------------------')
 
-    map_url = 'user_maps/user_'+str(id_get)+'/'+str(id_get)+'_filtered_map.html'
-
     # Return GeoJSON data, map object, unique years, and unique islands
 
     response_data = {
-        "mapHtml": map_url,
         'map_data': map_data
     }
 
     return jsonify(response_data)
 
-@app.route('/api/list', methods=['GET'])
-def get_default_data():
-
-    dataSet_raw = request.args.getlist('dataSet')
+def get_default_data_set():
+    # First data set in the files table, used when none was requested
+    return catalog.default_data_set()
+
+@app.route('/api/geojson', methods=['GET'])
+def get_filtered_geojson():
+    # Only the filtered fires as compact GeoJSON, for the map shell in
+    # static/map_shell.html or any other client drawing its own map
+    years_get = request.args.get('years', '')
+    months_get = request.args.get('months', '')
+    islands_get = request.args.get('islands', '')
+    dataSet_get = request.args.get('dataSet', '').strip('"') or get_default_data_set()
+    # Map zoom picks the simplified geometry level, bbox=west,south,east,north
+    # keeps only the fires in view
+    zoom = request.args.get('zoom', type=int)
+    bbox = request.args.get('bbox', '')
 
     if debug:
-        print(f"----This is the passed dataset {dataSet_raw}----")
-
-    # Connect to SQLite data sets
-    conn = sqlite3.connect('data_sets.db')
+        print(f"GeoJSON request for {dataSet_get}: {years_get} / {months_get} / {islands_get} zoom {zoom} bbox {bbox}")
 
-    # Create a cursor object to interact with the database
-    cursor = conn.cursor()
+    try:
+        bounds = [float(value) for value in bbox.split(',')] if bbox else None
+    except ValueError:
+        return jsonify({'error': 'bbox must be west,south,east,north'}), 400
+    if bounds is not None and (len(bounds) != 4 or not all(math.isfinite(value) for value in bounds)):
+        return jsonify({'error': 'bbox must be west,south,east,north'}), 400
 
-    #select the first entry in the table to be the default
-    cursor.execute("SELECT file_name FROM files LIMIT 1")
+    try:
+        version = source_mtime(dataSet_get)
+    except (FileNotFoundError, OSError):
+        return jsonify({'error': f"Unknown data set '{dataSet_get}'"}), 404
+
+    # The payload only changes when the selection or the data set does
+    etag = make_key(dataSet_get, version, years_get, months_get, islands_get,
+                    extra={'zoom': zoom, 'bbox': bounds})
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        gdf = dataset_cache.query(dataSet_get, years_get, months_get, islands_get, zoom=zoom)
+        if bounds is not None:
+            west, south, east, north = bounds
+            gdf = gdf.cx[west:east, south:north]
+        payload = features_geojson(gdf)
+
+        if 'gzip' in request.accept_encodings:
+            response = app.response_class(gzip_bytes(payload), mimetype='application/geo+json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = app.response_class(payload, mimetype='application/geo+json')
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+@app.route('/api/summary', methods=['GET'])
+def get_burn_summary():
+    # Size class table of the filtered fires as JSON, the same numbers as the
+    # map legend plus a per island/year breakdown
+    years_get = request.args.get('years', '')
+    months_get = request.args.get('months', '')
+    islands_get = request.args.get('islands', '')
+    dataSet_get = request.args.get('dataSet', '').strip('"') or get_default_data_set()
 
-    files = cursor.fetchone()
-    files_formatted = files[0].strip()
-    print(files_formatted)
+    try:
+        summary = cube_summary(dataSet_get, years_get, months_get, islands_get)
+        breakdown = cube_breakdown(dataSet_get, years_get, months_get, islands_get)
+    except (FileNotFoundError, OSError):
+        return jsonify({'error': f"Unknown data set '{dataSet_get}'"}), 404
+
+    for row in summary['sizeClasses'] + breakdown + [summary['totals']]:
+        row['acreage'] = json_number(row['acreage'])
+
+    return jsonify({
+        'dataSet': dataSet_get,
+        'sizeClasses': summary['sizeClasses'],
+        'totals': summary['totals'],
+        'landArea': summary['landArea'],
+        'percentBurned': json_number(summary['percentBurned']),
+        'byIslandYear': breakdown,
+    })
+
+@app.route('/api/stats', methods=['GET'])
+def get_burn_stats():
+    # Just the legend numbers (size classes, totals, % of land burned) without
+    # rendering a map or touching geometry. Repeated selections are memoized.
+    years_get = request.args.get('years', '')
+    months_get = request.args.get('months', '')
+    islands_get = request.args.get('islands', '')
+    dataSet_get = request.args.get('dataSet', '').strip('"') or get_default_data_set()
 
-    conn.close()
+    try:
+        stats = burn_stats(dataSet_get, years_get, months_get, islands_get)
+    except (FileNotFoundError, OSError):
+        return jsonify({'error': f"Unknown data set '{dataSet_get}'"}), 404
 
-    default_dataSet = files_formatted
+    return jsonify(stats)
 
-    # Replace 'folder_path' with the directory path you want to search
-    folder_path = 'ExampleFiles'
-    zip_files = find_zip_files(folder_path)
+@app.route('/tiles/<data_set>/<int:z>/<int:x>/<int:y>.mvt', methods=['GET'])
+def get_vector_tile(data_set, z, x, y):
+    # Mapbox vector tile of the filtered fires, cut on first request and
+    # served from output/tile_cache afterwards
+    if not valid_tile(z, x, y) or data_set != os.path.basename(data_set) or data_set.startswith('.'):
+        return jsonify({'error': 'Invalid tile'}), 404
 
-    with sqlite3.connect('data_sets.db') as db_connection:
-        cursor = db_connection.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-                    file_name TEXT PRIMARY KEY,
-                    unzipped INTEGER,
-                    total_islands Text,
-                    total_years Text,
-                    unique_months_str TEXT)''')
-        cursor.close()
+    try:
+        path, etag = get_tile(data_set, z, x, y,
+                              request.args.get('years', ''),
+                              request.args.get('months', ''),
+                              request.args.get('islands', ''))
+    except (FileNotFoundError, OSError):
+        return jsonify({'error': f"Unknown data set '{data_set}'"}), 404
 
-        if zip_files:
-            if debug:
-                print("Zip files found:")
-            for zip_file in zip_files:
-                if not check_unzipped(zip_file):
-                    unzip_and_update_db(zip_file, db_connection)
-                else:
-                    if debug:
-                        print(f"File '{os.path.basename(zip_file)}' already unzipped.")
-        else:
-            if debug:
-                print("No zip files found in the specified folder.")
+    return send_file(path, mimetype='application/vnd.mapbox-vector-tile',
+                     etag=etag, conditional=True, max_age=3600)
 
-        try:
-            file_name = dataSet_raw[0].strip('"')
-        except:
-            file_name = default_dataSet
+@app.route('/api/list', methods=['GET'])
+def get_default_data():
 
-        entry = retrieve_file_info(file_name, db_connection)
-        if entry:
-            total_islands, total_years, unique_months_str = entry
-        else:
-            default_data = retrieve_file_info(default_dataSet, db_connection)
-            total_islands, total_years, unique_months_str = default_data
-        data_sets = get_file_names(db_connection)
+    dataSet_raw = request.args.getlist('dataSet')
 
-        year_list = [item for item in total_years.split(',')]
-        island_list = [item for item in total_islands.split(',')]
-        month_list = [item for item in unique_months_str.split(',')]
+    if debug:
+        print(f"----This is the passed dataset {dataSet_raw}----")
 
-        if debug:
-            print(f'found data set --------------{data_sets}')
-            print(f'Entry value is {entry}')
-            print(f"Total Islands: {island_list}")
-            print(f"Total Years: {year_list}")
-            print(f"Unique Months: {month_list}")
+    try:
+        file_name = dataSet_raw[0].strip('"')
+    except:
+        file_name = None
 
+    # Served from memory, unknown data sets get the default one
+    response_data, etag = catalog.listing(file_name)
+    if response_data is None:
+        return jsonify({'error': 'No data sets available'}), 404
 
-        response_data = {
-            "allYears": year_list,
-            "allIslands": island_list,
-            "allMonths": month_list,
-            "allDataSets": list(data_sets)
-        }
+    if debug:
+        print(f'found data set --------------{response_data["allDataSets"]}')
+        print(f"Total Islands: {response_data['allIslands']}")
+        print(f"Total Years: {response_data['allYears']}")
+        print(f"Unique Months: {response_data['allMonths']}")
 
-    return jsonify(response_data)
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(response_data)
+    # Changes on upload or delete, so clients revalidate every time
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/existing', methods=['GET'])
 def db_check():
@@ -620,7 +479,9 @@ def db_check():
                     map_data = file.read()
     else:
         id_num = int(param1[0])
-        if not check_id_exists(id_num):
+        # Also keeps the session and its saved map from being evicted
+        exists, map_data = open_session(id_num)
+        if not exists:
             if debug:
                 print("It doesn't exist")
             id_num = insert_entry_with_checked_id()
@@ -629,7 +490,7 @@ def db_check():
         else:
             if debug:
                 print("It exists")
-            if not check_map_html_exists(id_num):
+            if map_data is None:
                 if debug:
                     print("-+-+-+-no default map data found-+-+-+-")
                 with open(default_map, "r") as file:
@@ -637,7 +498,6 @@ def db_check():
             else:
                 if debug:
                     print("-+-+-+-Default map data found-+-+-+-")
-                map_data = get_map_html(id_num)
 
     response_data = {
         "id_num": id_num,
@@ -654,30 +514,16 @@ def generate_shape_zip():
 
     id_get = request.args.get('id_num')
 
-    temp_values = get_values_by_id(id_get)
+    # Downloading the saved selection counts as using the session
+    temp_values = get_values_by_id(id_get, touch=True)
 
     years = temp_values[2]
     islands = temp_values[3]
     months = temp_values[4]
     dataSet_get = temp_values[5]
 
-    # Connect to SQLite data sets
-    conn = sqlite3.connect('data_sets.db')
-
-    # Create a cursor object to interact with the database
-    cursor = conn.cursor()
-
-    #select the first entry in the table to be the default
-    cursor.execute("SELECT file_name FROM files LIMIT 1")
-
-    files = cursor.fetchone()
-    files_formatted = files[0].strip()
-    files_clean = f'"{files_formatted}"'
-    print(files_clean)
-
-    conn.close()
-
-    default_dataSet = files_clean
+    #the first data set in the catalog is the default
+    default_dataSet = f'"{catalog.default_data_set()}"'
 
     if debug:
         print(f"mapZip Years: {years}")
@@ -685,124 +531,98 @@ def generate_shape_zip():
         print(f"mapZip Months: {months}")
         print(f"mapZip Dataset: {dataSet_get}")
 
-    try:
-        shapefile_path = "ExampleFiles/"+str(dataSet_get)+"/"+str(dataSet_get)+".shp"
-        if debug:
-            print("Found existing dataset to download")
-    except:
-        shapefile_path ='ExampleFiles/'+str(default_dataSet)+'/'+str(default_dataSet)+'.shp'
+    if not dataSet_get:
+        dataSet_get = default_dataSet[1:-1]
         if debug:
             print("No dataset found using default for download")
 
-    if debug:
-        print(f"This is the shapefile_path in mapZip: {shapefile_path}")
-
-    gdf = gpd.read_file(shapefile_path)
-
-    # Call the drop_multipolygons function to remove MultiPolygons
-    gdf = drop_multipolygons(gdf)
-
-    gdf = filter_geo_data(gdf, years, months, islands)
-
-    user_folder = user_dir+'/output/user_maps/'+'user_'+str(id_get)
-
-    if debug:
-        print(f"saving map to user folder {user_folder}")
-        print(f"This is the user_dir {user_dir}")
-
-    # Save GeoDataFrame to a shapefile
-    temp_shapefile_path = user_folder+'/shapefiles'
-    if debug:
-        print(f"saving map to user folder {temp_shapefile_path}")
-
-    try:
-        if debug:
-            print("Attempting to set up temp folder")
-        os.makedirs(temp_shapefile_path, exist_ok=True)
-        if debug:
-            print("Set up temp folder")
-    except OSError as e:
-            print(f"Failed to create directory '{temp_shapefile_path}': {e}")
-    if debug:
-        print("Made the shp folder")
-    gdf.to_file(temp_shapefile_path, driver='ESRI Shapefile')
-    if debug:
-        print("converting gdf to file")
-
-    # Instead of saving to disk, create the Zip file in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(temp_shapefile_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                zipf.write(file_path, os.path.relpath(file_path, temp_shapefile_path))
+    # The zip is written once per selection and served from the export cache
+    zip_path, etag, mimetype = get_export(dataSet_get, years, months, islands, 'shp')
 
-    if debug:
-        print("saved zip data to memory")
+    # download=1 streams the zip itself, with ETag and Range support, instead
+    # of base64 inside JSON
+    if request.args.get('download') in ('1', 'true'):
+        return send_file(zip_path, mimetype=mimetype, as_attachment=True,
+                         download_name='HWMO_Map_Data.zip', etag=etag, conditional=True)
 
-    # Get the contents of the Zip file from the buffer
-    zip_buffer.seek(0)
-    zip_contents = zip_buffer.getvalue()
+    with open(zip_path, 'rb') as zip_file:
+        zip_contents = zip_file.read()
 
     # Encode the binary data to base64
     base64_encoded_zip = base64.b64encode(zip_contents).decode('utf-8')
 
-
-    # Clean up the temporary shapefiles directory
-    shutil.rmtree(user_folder)
-
     response_data = {
         'shape_zip': base64_encoded_zip,
     }
 
     return jsonify(response_data)
 
-@app.route('/file-tree')
-def get_file_tree():
-    directory_path = 'ExampleFiles'  # Replace with your folder path
-    file_tree = get_files_in_directory(directory_path)
-    return jsonify(file_tree)
-
-def get_directory_size(directory):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
-
-def get_modification_date(path):
-    timestamp = os.path.getmtime(path)
-    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-
-def get_files_in_directory(directory_path):
-    files = []
-    for item in os.listdir(directory_path):
-        item_path = os.path.join(directory_path, item)
-        is_directory = os.path.isdir(item_path)
-
-        file_object = {
-            'id': item,
-            'name': item,
-            'isDir': is_directory,
-            'isHidden': is_directory,
-            'openable': bool(0),
-            'files': []
-        }
-
-        if not is_directory:
-            file_object['size'] = os.path.getsize(item_path)
-            file_object['modDate'] = datetime.fromtimestamp(os.path.getmtime(item_path)).strftime('%Y-%m-%d %H:%M:%S')
+@app.route('/api/export', methods=['GET'])
+def export_filtered_data():
+    # Filtered fires as a file in any of export_formats, either for the
+    # selection saved under id_num or for dataSet/years/months/islands
+    fmt = request.args.get('format', 'gpkg')
+    if fmt not in export_formats:
+        return jsonify({'error': f"Unknown format '{fmt}'", 'formats': list(export_formats)}), 400
 
+    id_get = request.args.get('id_num')
+    if id_get:
+        temp_values = get_values_by_id(id_get, touch=True)
+        if temp_values is None:
+            return jsonify({'error': f"Unknown id '{id_get}'"}), 404
+        years, islands, months, dataSet_get = temp_values[2], temp_values[3], temp_values[4], temp_values[5]
+    else:
+        years = request.args.get('years', '')
+        months = request.args.get('months', '')
+        islands = request.args.get('islands', '')
+        dataSet_get = request.args.get('dataSet', '').strip('"')
+    dataSet_get = dataSet_get or get_default_data_set()
 
-        if is_directory:
-            file_object['files'] = get_files_in_directory(item_path)
-            file_object['size'] = get_directory_size(item_path)  # Get directory size
-            file_object['modDate'] = get_modification_date(item_path)  # Get modification date
-
-        files.append(file_object)
+    try:
+        path, etag, mimetype = get_export(dataSet_get, years, months, islands, fmt)
+    except (FileNotFoundError, OSError):
+        return jsonify({'error': f"Unknown data set '{dataSet_get}'"}), 404
+
+    return send_file(path, mimetype=mimetype, as_attachment=True,
+                     download_name=f'HWMO_Map_Data.{export_formats[fmt][0]}', etag=etag, conditional=True)
+
+@app.route('/api/exportStats', methods=['GET'])
+def get_export_stats():
+    return jsonify(export_stats.stats())
+
+@app.route('/api/cacheStats', methods=['GET'])
+def get_cache_stats():
+    stats_info = cached_burn_stats.cache_info()
+    return jsonify({
+        'dataSets': dataset_cache.stats(),
+        'maps': map_cache.stats(),
+        'stats': {'hits': stats_info.hits, 'misses': stats_info.misses,
+                  'entries': stats_info.currsize, 'maxEntries': stats_info.maxsize},
+        'catalog': catalog.stats(),
+        'fileTree': file_index.stats(),
+        'tiles': tile_index.stats(),
+    })
+
+@app.route('/api/sessionStats', methods=['GET'])
+def get_session_stats():
+    return jsonify(session_stats())
 
-    return files
+@app.route('/file-tree')
+def get_file_tree():
+    # The whole tree by default. path=<folder> lists one folder, depth=1
+    # leaves its subfolders to be expanded with another request, and
+    # offset/limit page through large folders.
+    path = request.args.get('path', '')
+    depth = request.args.get('depth', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', type=int)
+
+    file_tree, total = file_index.listing(path, depth, offset, limit)
+    if file_tree is None:
+        return jsonify({'error': f"No folder '{path}'"}), 404
+    response = jsonify(file_tree)
+    response.headers['X-Total-Count'] = str(total)
+    return response
 
 @app.route('/delete-folders', methods=['DELETE'])
 def delete_folders():
@@ -831,7 +651,17 @@ def delete_folders():
                 cursor.execute("DELETE FROM files WHERE file_name = ?", (base_file_name,))
                 conn.commit()
 
+                file_index.update(file_name)
+                file_index.update(base_file_name)
+
+                dataset_cache.invalidate(base_file_name)
+                map_cache.invalidate(base_file_name)
+                invalidate_tiles(base_file_name)
+                delete_cube(base_file_name)
+                invalidate_exports(base_file_name)
+
         conn.close()
+        catalog.refresh()
 
         return jsonify({'message': 'Folders and files deleted successfully'})
     except Exception as e:
@@ -847,26 +677,32 @@ def upload_zip():
         if uploaded_file.filename == '':
             return {'error': 'No selected file'}, 400
 
+        data_set = os.path.splitext(uploaded_file.filename)[0]
+        if ingest_queue.pending(data_set):
+            return {'error': f"'{data_set}' is still being ingested"}, 409
+
         # Save the uploaded file to a specific directory
         # Replace 'uploads' with your desired directory
         uploaded_file.save('ExampleFiles/' + uploaded_file.filename)
+        file_index.update(uploaded_file.filename)
 
-        with sqlite3.connect('data_sets.db') as db_connection:
-            cursor = db_connection.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-                        file_name TEXT PRIMARY KEY,
-                        unzipped INTEGER,
-                        total_islands Text,
-                        total_years Text,
-                        unique_months_str TEXT)''')
-            cursor.close()
+        # Drop any parsed copy, rendered map or tile of a data set uploaded
+        # again, the worker ingests and seeds it anew
+        ingest_done(data_set)
+        job_id = ingest_queue.submit('ExampleFiles/' + uploaded_file.filename)
 
-            unzip_and_update_db(('ExampleFiles/' + uploaded_file.filename), db_connection)
-
-        return {'message': 'File uploaded successfully'}, 200
+        return {'message': 'File uploaded, ingest queued', 'jobId': job_id}, 202
     except Exception as e:
         return {'error': str(e)}, 500
 
+@app.route('/api/ingestJobs/<int:job_id>', methods=['GET'])
+def ingest_job(job_id):
+    # Stage and progress (0 to 1) of an upload being ingested
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'No such job'}), 404
+    return jsonify(job)
+
 @app.route('/download-files', methods=['GET'])
 def download_files():
 
@@ -874,29 +710,24 @@ def download_files():
 
     try:
         file_ids = request.args.get('fileIds').split(',')
-        temp_folder = 'output/temp_admin_download_folder'
-
-        # Create a temporary folder to store downloaded files
-        os.makedirs(temp_folder, exist_ok=True)
 
-        # Compress selected files from ExampleFiles into a ZIP archive
-        zip_path = os.path.join(temp_folder, 'downloaded_files.zip')
-        with zipfile.ZipFile(zip_path, 'w') as zip_file:
-            for file_id in file_ids:
-                file_path = os.path.join(example_files_dir, file_id)
-                if os.path.exists(file_path):
-                    zip_file.write(file_path, os.path.basename(file_path))
-
-        # Read the contents of the ZIP file
-        with open(zip_path, 'rb') as f:
-            zip_contents = f.read()
+        # Selected files and folders, anything outside ExampleFiles is ignored
+        root = os.path.realpath(example_files_dir)
+        file_paths = []
+        for file_id in file_ids:
+            file_path = os.path.realpath(os.path.join(example_files_dir, file_id))
+            if file_path.startswith(root + os.sep) and os.path.exists(file_path):
+                file_paths.append(file_path)
+
+        # download=1 streams the zip as it is built, read from the source
+        # files in chunks, with no temp file and no base64
+        if request.args.get('download') in ('1', 'true'):
+            response = app.response_class(stream_with_context(stream_zip(file_paths)), mimetype='application/zip')
+            response.headers['Content-Disposition'] = 'attachment; filename=download_data.zip'
+            return response
 
         # Encode the binary data to base64
-        base64_encoded_zip = base64.b64encode(zip_contents).decode('utf-8')
-
-
-        # Clean up the temporary shapefiles directory
-        shutil.rmtree(temp_folder)
+        base64_encoded_zip = base64.b64encode(b''.join(stream_zip(file_paths))).decode('utf-8')
 
         response_data = {
             'zip_folder': base64_encoded_zip,
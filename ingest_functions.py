@@ -0,0 +1,274 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import geopandas as gpd
+
+from dataset_cache import (attribute_source, data_root, dataset_paths, extract_uploads, metadata_columns,
+                           source_mtime, write_map_copy)
+from dataset_index import write_dataset_index
+from stats_functions import write_cube
+from tile_functions import seed_tiles
+
+# Set debug flag
+debug = False
+
+# Database holding the files table and the ingest job table
+ingest_db = 'data_sets.db'
+
+# Uploads ingested at the same time, override with INGEST_WORKERS
+ingest_workers = int(os.environ.get('INGEST_WORKERS', 2))
+
+# Share of the job done when each stage starts. Extraction moves the bar
+# from 'extract' to 'metadata' as the archive members are written.
+ingest_stages = {
+    'validate': 0.0,
+    'extract': 0.05,
+    'metadata': 0.5,
+    'index': 0.55,
+    'reproject': 0.6,
+    'statistics': 0.8,
+    'tiles': 0.85,
+    'register': 0.98,
+}
+
+def sort_months(arr):
+    months = [
+        'January', 'February', 'March', 'April', 'May', 'June',
+        'July', 'August', 'September', 'October', 'November', 'December'
+    ]
+
+    only_months = sorted([month for month in arr if month in months], key=lambda x: months.index(x))
+    other_items = [item for item in arr if item not in months]
+
+    return only_months + other_items
+
+# Function to process shapefile and retrieve required information, only
+# the Year, FireMonth and Island columns are read
+def process_shapefile(shapefile_path):
+    gdf_total = gpd.read_file(shapefile_path, columns=metadata_columns, ignore_geometry=True)
+    unique_months = list(gdf_total['FireMonth'].unique())
+    sorted_months = sort_months(unique_months)
+    all_islands = ','.join(map(str, list(gdf_total['Island'].unique())))
+    all_years = ','.join(map(str, sorted(list(gdf_total['Year'].unique()))))
+    unique_months_str = ','.join(map(str, sorted_months))
+    return all_islands, all_years, unique_months_str
+
+def current_time():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def connect():
+    return sqlite3.connect(ingest_db, timeout=30)
+
+def create_files_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                    file_name TEXT PRIMARY KEY,
+                    unzipped INTEGER,
+                    total_islands Text,
+                    total_years Text,
+                    unique_months_str TEXT)''')
+
+def create_job_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingest_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    data_set TEXT,
+                    zip_path TEXT,
+                    status TEXT,
+                    stage TEXT,
+                    progress REAL,
+                    message TEXT,
+                    created DATETIME,
+                    started DATETIME,
+                    finished DATETIME,
+                    archive_mtime REAL
+                )''')
+    # The archive's mtime lets a failed archive be told apart from a new
+    # upload under the same name
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(ingest_jobs)")]
+    if 'archive_mtime' not in columns:
+        conn.execute("ALTER TABLE ingest_jobs ADD COLUMN archive_mtime REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS ingest_jobs_data_set ON ingest_jobs (data_set, status)")
+
+def update_job(job_id, **fields):
+    with connect() as conn:
+        conn.execute(f"UPDATE ingest_jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                     list(fields.values()) + [job_id])
+
+def get_job(job_id):
+    with connect() as conn:
+        create_job_table(conn)
+        row = conn.execute("SELECT id, data_set, status, stage, progress, message, created, started, finished "
+                           "FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    keys = ['jobId', 'dataSet', 'status', 'stage', 'progress', 'message', 'created', 'started', 'finished']
+    return dict(zip(keys, row))
+
+def validate_zip(zip_ref, data_set):
+    # The archive must hold <name>/<name>.shp with its .shx, .dbf and .prj,
+    # and nothing that would be extracted outside the data folder
+    names = set(zip_ref.namelist())
+    for name in names:
+        if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+            raise ValueError(f"Unsafe path '{name}' in archive")
+    for ext in ('.shp', '.shx', '.dbf', '.prj'):
+        if f'{data_set}/{data_set}{ext}' not in names:
+            raise ValueError(f"Archive has no '{data_set}/{data_set}{ext}'")
+
+def extract_zip(zip_ref, folder, job_id):
+    # Member by member so progress can be reported on large archives
+    members = zip_ref.infolist()
+    total = sum(member.file_size for member in members) or 1
+    done = 0
+    start, end = ingest_stages['extract'], ingest_stages['metadata']
+    for i, member in enumerate(members):
+        zip_ref.extract(member, path=folder)
+        done += member.file_size
+        if i % 10 == 0 or i == len(members) - 1:
+            update_job(job_id, progress=round(start + (end - start) * done / total, 3))
+
+def remove_extracted(zip_ref, folder):
+    for member in zip_ref.infolist():
+        path = os.path.join(folder, member.filename)
+        if not member.is_dir() and os.path.isfile(path):
+            os.remove(path)
+
+def run_ingest(job_id, zip_file):
+    # Runs in a worker process: validate, extract, derive metadata, index,
+    # reproject, aggregate and register one uploaded archive
+    data_set = os.path.splitext(os.path.basename(zip_file))[0]
+    update_job(job_id, status='running', started=current_time())
+
+    def stage(name):
+        update_job(job_id, stage=name, progress=ingest_stages[name])
+        if debug:
+            print(f"Ingest job {job_id} '{data_set}': {name}")
+
+    try:
+        stage('validate')
+        shp_path, _ = dataset_paths(data_set)
+        # A rejected archive is kept for the user to look at, its failed job
+        # stops it from being queued again until it is replaced
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            validate_zip(zip_ref, data_set)
+            if extract_uploads:
+                stage('extract')
+                extract_zip(zip_ref, os.path.dirname(zip_file), job_id)
+            else:
+                # Read from the zip, parts extracted from an earlier upload
+                # would otherwise be read in its place
+                remove_extracted(zip_ref, os.path.dirname(zip_file))
+                os.makedirs(os.path.dirname(shp_path), exist_ok=True)
+
+        # Metadata and indexes need no geometry, they read from the .dbf
+        source = attribute_source(data_set)
+        stage('metadata')
+        all_islands, all_years, sorted_months = process_shapefile(source)
+        # Year/FireMonth/Island indexes and the WGS84 copy used by the map
+        # are saved in the data set folder
+        stage('index')
+        write_dataset_index(shp_path, source_mtime(data_set), source)
+        stage('reproject')
+        write_map_copy(data_set)
+        # Burn statistics per year/month/island/size class for the legend
+        stage('statistics')
+        write_cube(data_set)
+        # Low zoom vector tiles of the whole data set, if enabled
+        stage('tiles')
+        seed_tiles(data_set)
+
+        stage('register')
+        with connect() as conn:
+            # An upload of an existing data set refreshes its metadata in place
+            conn.execute("INSERT INTO files (file_name, unzipped, total_islands, total_years, unique_months_str) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT(file_name) DO UPDATE SET unzipped = excluded.unzipped, total_islands = excluded.total_islands, "
+                         "total_years = excluded.total_years, unique_months_str = excluded.unique_months_str",
+                         (data_set, 1, all_islands, all_years, sorted_months))
+    except Exception as e:
+        print(f"Error ingesting '{os.path.basename(zip_file)}': {e}")
+        update_job(job_id, status='failed', message=str(e), finished=current_time())
+        return False
+
+    update_job(job_id, status='done', stage='done', progress=1.0, finished=current_time())
+    return True
+
+class IngestQueue:
+    # Runs ingest jobs in a pool of worker processes so uploads don't hold
+    # up the request threads. Jobs and their progress live in the
+    # ingest_jobs table, on_done(data_set) is called here once a job ends.
+
+    def __init__(self, workers, on_done=None):
+        self.workers = workers
+        self.on_done = on_done
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with connect() as conn:
+            create_files_table(conn)
+            create_job_table(conn)
+            # Jobs of a previous run can't finish anymore, their archives
+            # are queued again on the next scan
+            conn.execute("UPDATE ingest_jobs SET status = 'failed', message = 'Interrupted by a restart', finished = ?, "
+                         "archive_mtime = NULL WHERE status IN ('queued', 'running')", (current_time(),))
+
+    def submit(self, zip_file):
+        # Returns the job id, the existing one if this data set is already
+        # waiting or being ingested, or if this same archive already failed
+        data_set = os.path.splitext(os.path.basename(zip_file))[0]
+        archive_mtime = os.path.getmtime(zip_file)
+        with self._lock:
+            with connect() as conn:
+                # Holds the write lock from the check to the insert, another
+                # process watching the same folder may submit this archive too
+                conn.execute("BEGIN IMMEDIATE")
+                active = conn.execute("SELECT id FROM ingest_jobs WHERE data_set = ? AND status IN ('queued', 'running')",
+                                      (data_set,)).fetchone()
+                if active:
+                    return active[0]
+                latest = conn.execute("SELECT id, status, archive_mtime FROM ingest_jobs WHERE data_set = ? "
+                                      "ORDER BY id DESC LIMIT 1", (data_set,)).fetchone()
+                if latest and latest[1] == 'failed' and latest[2] == archive_mtime:
+                    return latest[0]
+                job_id = conn.execute("INSERT INTO ingest_jobs (data_set, zip_path, status, stage, progress, created, archive_mtime) "
+                                      "VALUES (?, ?, 'queued', 'queued', 0, ?, ?)",
+                                      (data_set, zip_file, current_time(), archive_mtime)).lastrowid
+
+            if self._executor is None:
+                # spawn keeps the workers clear of the threads and open
+                # connections of the web process
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            future = self._executor.submit(run_ingest, job_id, zip_file)
+
+        future.add_done_callback(lambda future: self._finished(job_id, data_set, future))
+        if debug:
+            print(f"Queued ingest job {job_id} for '{data_set}'")
+        return job_id
+
+    def pending(self, data_set):
+        with connect() as conn:
+            return conn.execute("SELECT 1 FROM ingest_jobs WHERE data_set = ? AND status IN ('queued', 'running')",
+                                (data_set,)).fetchone() is not None
+
+    def _finished(self, job_id, data_set, future):
+        error = future.exception()
+        if error is not None:
+            # The worker died before it could record the failure itself
+            update_job(job_id, status='failed', message=str(error), finished=current_time())
+        if self.on_done is not None:
+            self.on_done(data_set)
+
+# Function to search for zip files in a folder. Only the top level holds
+# uploads, zips inside data set folders are part of their data.
+def find_zip_files(folder_path=data_root):
+    return [entry.path for entry in os.scandir(folder_path) if entry.is_file() and entry.name.endswith('.zip')]
+
+# Function to check if a file has been unzipped
+def check_unzipped(file_path):
+    unzip_folder = os.path.splitext(file_path)[0]  # Extract folder name without the .zip extension
+    return os.path.exists(unzip_folder)
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from filter_functions import split_selection
+
+# Set debug flag
+debug = False
+
+# Rendered maps are kept on disk under <map_cache_dir>/<data set>/<key>.html
+map_cache_dir = os.path.join('output', 'map_cache')
+
+# Size budgets, override with MAP_CACHE_MEMORY_MB / MAP_CACHE_DISK_MB
+max_memory_bytes = int(os.environ.get('MAP_CACHE_MEMORY_MB', 128)) * 1024 * 1024
+max_disk_bytes = int(os.environ.get('MAP_CACHE_DISK_MB', 1024)) * 1024 * 1024
+
+def make_key(data_set, version, years, months, islands, extra=None):
+    # Same data set and same selected values give the same key no matter the
+    # order they were picked in or which user asked. extra holds any other
+    # request option that changes the output, such as the zoom level.
+    selection = {
+        'data_set': data_set,
+        'version': version,
+        'years': sorted(split_selection(years) or []),
+        'months': sorted(split_selection(months) or []),
+        'islands': sorted(split_selection(islands) or []),
+    }
+    if extra:
+        selection['extra'] = extra
+    return hashlib.sha256(json.dumps(selection, sort_keys=True).encode('utf-8')).hexdigest()
+
+class MapCache:
+    # Two level LRU cache of rendered map HTML: a small one in memory and a
+    # larger one on disk that survives restarts
+
+    def __init__(self, folder, memory_bytes, disk_bytes):
+        self.folder = folder
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = None
+        self._disk_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, data_set, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self.memory_hits += 1
+                self._memory.move_to_end(key)
+                return entry[1]
+
+        path = self._path(data_set, key)
+        try:
+            with open(path, 'r', encoding='utf-8') as map_file:
+                map_html = map_file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            self._load_disk_index()
+            if path in self._disk:
+                self._disk.move_to_end(path)
+            self._remember(data_set, key, map_html)
+        return map_html
+
+    def put(self, data_set, key, map_html):
+        path = self._path(data_set, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename so readers never see half a file
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as map_file:
+            map_file.write(map_html)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._load_disk_index()
+            if path in self._disk:
+                self._disk_size -= self._disk.pop(path)
+            self._disk[path] = os.path.getsize(path)
+            self._disk_size += self._disk[path]
+            while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+                oldest, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                try:
+                    os.remove(oldest)
+                except FileNotFoundError:
+                    pass
+            self._remember(data_set, key, map_html)
+
+    def invalidate(self, data_set):
+        # Drop every map rendered from a data set that was uploaded or deleted
+        with self._lock:
+            for key in [key for key, entry in self._memory.items() if entry[0] == data_set]:
+                self._memory_size -= len(self._memory.pop(key)[1])
+            folder = os.path.join(self.folder, data_set)
+            if self._disk is not None:
+                for path in [path for path in self._disk if os.path.dirname(path) == folder]:
+                    self._disk_size -= self._disk.pop(path)
+            shutil.rmtree(folder, ignore_errors=True)
+        if debug:
+            print(f"Cleared cached maps for '{data_set}'")
+
+    def stats(self):
+        with self._lock:
+            self._load_disk_index()
+            return {
+                'memoryHits': self.memory_hits,
+                'diskHits': self.disk_hits,
+                'misses': self.misses,
+                'memoryEntries': len(self._memory),
+                'memoryBytes': self._memory_size,
+                'diskEntries': len(self._disk),
+                'diskBytes': self._disk_size,
+            }
+
+    def _path(self, data_set, key):
+        return os.path.join(self.folder, data_set, key + '.html')
+
+    def _remember(self, data_set, key, map_html):
+        # Caller holds the lock
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key)[1])
+        if len(map_html) > self.memory_bytes:
+            return
+        self._memory[key] = (data_set, map_html)
+        self._memory_size += len(map_html)
+        while self._memory_size > self.memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _load_disk_index(self):
+        # Caller holds the lock. Files left by an earlier run are picked up
+        # oldest first so they are the first to be evicted.
+        if self._disk is not None:
+            return
+        found = []
+        if os.path.isdir(self.folder):
+            for data_set in os.scandir(self.folder):
+                if data_set.is_dir():
+                    for entry in os.scandir(data_set.path):
+                        if entry.name.endswith('.html'):
+                            stat = entry.stat()
+                            found.append((stat.st_mtime, entry.path, stat.st_size))
+        self._disk = OrderedDict((path, size) for _, path, size in sorted(found))
+        self._disk_size = sum(self._disk.values())
+
+map_cache = MapCache(map_cache_dir, max_memory_bytes, max_disk_bytes)
@@ -0,0 +1,42 @@
+import numpy as np
+from folium.plugins import FastMarkerCluster
+
+from vector_functions import coordinate_decimals
+
+# Set debug flag
+debug = False
+
+# Builds one marker per [lat, lon, acres, year, month] row in the browser. The
+# popup table is only made when a marker is opened, so the page carries one
+# array of numbers instead of a marker and an HTML table per fire.
+marker_callback = """function (row) {
+    var cell = '<td style="border: 1px solid black; padding: 8px;">';
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(function () {
+        return '<table style="border-collapse: collapse; width: 100px;">' +
+            '<tr>' + cell + 'Acres</td>' + cell + (row[2] === null ? 'nan' : row[2]) + '</td></tr>' +
+            '<tr>' + cell + 'Year</td>' + cell + row[3] + '</td></tr>' +
+            '<tr>' + cell + 'Month</td>' + cell + row[4] + '</td></tr>' +
+            '</table>';
+    }, {maxWidth: '100%'});
+    return marker;
+}"""
+
+def marker_rows(gdf):
+    # Centroid and popup values of each fire, NaN acreage goes out as null
+    lats = np.round(gdf['centroid_lat'].to_numpy(dtype=float), coordinate_decimals)
+    lons = np.round(gdf['centroid_lon'].to_numpy(dtype=float), coordinate_decimals)
+    acreage = np.round(gdf['Acerage'].to_numpy(dtype=float), 2)
+    return [
+        [lat, lon, None if np.isnan(acres) else acres, year, month]
+        for lat, lon, acres, year, month in zip(
+            lats.tolist(), lons.tolist(), acreage.tolist(),
+            gdf['Year'].astype(int).tolist(), gdf['FireMonth'].astype(object).tolist())
+    ]
+
+def add_fire_markers(m, gdf):
+    # One clustered layer holding a marker at the centroid of every fire
+    rows = marker_rows(gdf)
+    if debug:
+        print(f"Adding {len(rows)} markers")
+    return FastMarkerCluster(rows, callback=marker_callback).add_to(m)
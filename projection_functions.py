@@ -0,0 +1,53 @@
+from functools import lru_cache
+
+import numpy as np
+import pyproj
+import shapely
+
+# Coordinates handed to folium/leaflet
+map_crs = 'EPSG:4326'
+
+# Columns added by build_map_copy that are not part of the source data
+derived_columns = ['centroid_lon', 'centroid_lat', 'area_m2']
+
+@lru_cache(maxsize=32)
+def get_transformer(prj):
+    # One transformer per distinct .prj, always_xy keeps (lon, lat) order
+    return pyproj.Transformer.from_crs(pyproj.CRS.from_wkt(prj), map_crs, always_xy=True)
+
+def reproject_geometries(geometries, transformer):
+    # shapely.transform hands every vertex of every geometry to the
+    # transformer as one array, holes and multipolygon parts included
+    def transform_array(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(np.asarray(geometries), transform_array)
+
+def reproject_points(x, y, transformer):
+    return transformer.transform(np.asarray(x), np.asarray(y))
+
+def reproject_centroids(geometries, transformer):
+    # Centroids are taken in the source projection like before, then moved
+    centroids = shapely.centroid(np.asarray(geometries))
+    return reproject_points(shapely.get_x(centroids), shapely.get_y(centroids), transformer)
+
+def build_map_copy(gdf, prj):
+    # WGS84 copy of a data set with the centroid and area of every fire
+    # worked out once, so map requests never have to reproject
+    transformer = get_transformer(prj)
+    source_crs = pyproj.CRS.from_wkt(prj)
+    geometries = gdf['geometry'].values
+
+    # Areas need a projected CRS, geographic data sets use their UTM zone
+    if source_crs.is_projected:
+        areas = shapely.area(np.asarray(geometries))
+    else:
+        geographic = gdf.set_crs(source_crs, allow_override=True)
+        areas = geographic.to_crs(geographic.estimate_utm_crs()).area.to_numpy()
+
+    map_copy = gdf.copy()
+    map_copy['centroid_lon'], map_copy['centroid_lat'] = reproject_centroids(geometries, transformer)
+    map_copy['area_m2'] = areas
+    map_copy['geometry'] = reproject_geometries(geometries, transformer)
+    return map_copy.set_crs(map_crs, allow_override=True)
@@ -36,6 +36,9 @@ const isDevelopment = process.env.NODE_ENV === 'development';
 // Set the base URL accordingly
 const baseURL = isDevelopment ? 'http://127.0.0.1:5000' : '';
 
+// Zoom the map opens at, polygons are simplified for it
+const mapZoom = 10;
+
 const Alert = React.forwardRef(function Alert(props, ref) {
   return <MuiAlert elevation={6} ref={ref} variant="filled" {...props} />;
 });
@@ -62,11 +65,11 @@ const fetchData = async (
         islands: selectedIsland.join(','),
         id_num: savedID,
         dataSet: savedDataSet,
+        zoom: mapZoom,
       },
     });
-    const {mapHtml, map_data} =
+    const {map_data} =
       response.data;
-    localStorage.setItem('user_map', JSON.stringify(mapHtml));
     setOpenGood(false);
     setOpenSuccess(true);
     setGeojsonData(map_data);
@@ -251,28 +254,15 @@ const MapPage = () => {
 const handleSHPDownload = async () => {
   try {
     const savedID = localStorage.getItem('id').toString();
-    const mapZipApiUrl = `${baseURL}/api/mapZip`;
-      const params = {
-        id_num: savedID, // Replace 'savedID' with your variable
-      };
-
-      const response = await axios.get(mapZipApiUrl, { params });
-    const base64EncodedZip = response.data.shape_zip;
-
-    // Decode base64-encoded ZIP file to binary data
-    const zipData = atob(base64EncodedZip);
-    const arrayBuffer = new ArrayBuffer(zipData.length);
-    const uint8Array = new Uint8Array(arrayBuffer);
-    for (let i = 0; i < zipData.length; i++) {
-      uint8Array[i] = zipData.charCodeAt(i);
-    }
-
-    // Create Blob from binary data
-    const blob = new Blob([uint8Array], { type: 'application/zip' });
+    // download=1 streams the zip straight to disk, no base64 or Blob in memory
+    const params = new URLSearchParams({
+      id_num: savedID,
+      download: '1',
+    });
 
-    // Create download link and trigger download
+    // Trigger download
     const link = document.createElement('a');
-    link.href = URL.createObjectURL(blob);
+    link.href = `${baseURL}/api/mapZip?${params.toString()}`;
     link.download = 'HWMO_Map_Data.zip';
 
     document.body.appendChild(link);
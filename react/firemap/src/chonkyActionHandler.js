@@ -50,8 +50,21 @@ const handleAction = async (data) => {
           });
 
           if (uploadResponse.ok) {
-            console.log('File uploaded successfully');
-            resolve(true);
+            // The archive is ingested in the background, wait for its job
+            const { jobId } = await uploadResponse.json();
+            let job = { status: 'queued' };
+            while (job.status === 'queued' || job.status === 'running') {
+              await new Promise((wait) => setTimeout(wait, 1000));
+              job = await (await fetch(`${baseURL}/api/ingestJobs/${jobId}`)).json();
+              console.log(`Ingesting ${job.dataSet}: ${job.stage} ${Math.round(job.progress * 100)}%`);
+            }
+            if (job.status === 'done') {
+              console.log('File uploaded successfully');
+              resolve(true);
+            } else {
+              console.error('Failed to ingest file:', job.message);
+              reject(false);
+            }
           } else {
             console.error('Failed to upload file');
             reject(false);
@@ -66,32 +79,18 @@ const handleAction = async (data) => {
     if (data.id === 'download') {
       const selectedFiles = data.state.selectedFiles;
       const fileIds = selectedFiles.map((file) => file.id);
-      const ZipApiUrl = `${baseURL}/download-files`;
-      const params = { fileIds: fileIds.join(',') };
-      
+      // download=1 streams the zip straight to disk, no base64 or Blob in memory
+      const params = new URLSearchParams({ fileIds: fileIds.join(','), download: '1' });
+
       try {
-        const response = await axios.get(ZipApiUrl, { params });
-      
-        // Assuming the response data contains 'data.zip_folder'
-        const base64EncodedZip = response.data.zip_folder;
-        const zipData = atob(base64EncodedZip);
-        const uint8Array = new Uint8Array(zipData.length);
-      
-        for (let i = 0; i < zipData.length; i++) {
-          uint8Array[i] = zipData.charCodeAt(i);
-        }
-      
-        const blob = new Blob([uint8Array], { type: 'application/zip' });
-        const url = window.URL.createObjectURL(blob);
-      
         const link = document.createElement('a');
-        link.href = url;
+        link.href = `${baseURL}/download-files?${params.toString()}`;
         link.download = 'download_data.zip';
-      
+
         document.body.appendChild(link);
         link.click();
         document.body.removeChild(link);
-      
+
         console.log('Downloaded data');
         return true;
       } catch (error) {
@@ -541,4 +541,5 @@ def generate_shape_zip():
 
 
 if __name__ == '__main__':
+    migrate_database()
     app.run(port=3000)
\ No newline at end of file
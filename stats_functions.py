@@ -0,0 +1,244 @@
+import math
+import os
+import sqlite3
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import dataset_cache, source_mtime
+from filter_functions import split_selection
+
+# Set debug flag
+debug = False
+
+#land area for islands to calculate % burn total
+island_land_areas = {
+    'Tinian': 25010,  # Replace with actual land area in acres
+    'Saipan': 29400,  # Replace with actual land area in acres
+    'Rota': 21036.8,    # Replace with actual land area in acres
+    'Guam': 135700,   # Replace with actual land area in acres
+    'Palau': 113300,  # Replace with actual land area in acres
+    'Yap': 24710      # Replace with actual land area in acres
+}
+
+# Database holding the pre-aggregated burn_cube table
+stats_db = 'data_sets.db'
+
+# Cube dimensions: the Year/FireMonth/Island filters, then the size class
+cube_dimensions = ['year', 'month', 'island', 'size_class']
+
+# Number of distinct selections /api/stats remembers per process,
+# override with STATS_CACHE_SIZE
+stats_cache_size = int(os.environ.get('STATS_CACHE_SIZE', 1024))
+
+# Size classes of the burn summary table, smallest first
+size_class_labels = ['0-0.25', '0.26-9', '10-99', '100-299', '300-999', '1000-9999']
+undefined_class = 'Undefined'
+
+# Upper edge of each class (inclusive). Acreage is rounded to two decimals
+# first, so nothing can land in the gaps between classes such as 0.25-0.26.
+# Anything above the last edge or missing is 'Undefined'.
+size_class_edges = [-np.inf, 0.25, 9.99, 99.99, 299.99, 999.99, 9999.99]
+
+def round_acreage(acreage):
+    return np.round(np.asarray(acreage, dtype=float), 2)
+
+def size_classes(acreage):
+    # Size class of each fire, same bins as the old categorize_acreage
+    classes = pd.cut(round_acreage(acreage), bins=size_class_edges, right=True, labels=size_class_labels)
+    return classes.add_categories([undefined_class]).fillna(undefined_class)
+
+def class_table(frame, by=()):
+    # Count and acreage per size class (and any extra columns). A class that
+    # has a fire without acreage gets NaN acreage, like the old loop did.
+    frame = frame.assign(sizeClass=size_classes(frame['Acerage']), acreage=round_acreage(frame['Acerage']))
+    groups = frame.groupby(list(by) + ['sizeClass'], observed=True)['acreage']
+    table = pd.DataFrame({
+        'count': groups.size(),
+        'acreage': groups.sum(),
+        'missing': groups.count() < groups.size(),
+    })
+    table.loc[table['missing'], 'acreage'] = np.nan
+    return table.drop(columns='missing').reset_index()
+
+def land_area(islands):
+    return sum(area for island, area in island_land_areas.items() if island in islands)
+
+def selected_islands(available_islands, islands):
+    # Selected islands that are in the data set, all of them when none are
+    available_islands = list(available_islands)
+    return [island for island in (split_selection(islands) or available_islands) if island in available_islands]
+
+def summarize_rows(rows, islands):
+    # Numbers behind the summary legend: rows per size class in table order,
+    # the totals and the share of the selected islands' land that burned
+    total_count = sum(row['count'] for row in rows)
+    total_acres = sum(row['acreage'] for row in rows if not math.isnan(row['acreage']))
+
+    total_land_area = land_area(islands)
+    percent_burned = (total_acres / total_land_area) * 100 if total_land_area else None
+
+    return {
+        'sizeClasses': rows,
+        'totals': {'count': total_count, 'acreage': total_acres},
+        'landArea': total_land_area,
+        'percentBurned': percent_burned,
+    }
+
+def summarize_burns(frame, islands):
+    # Same summary straight from a frame of fires, without the cube
+    rows = [
+        {'sizeClass': str(row.sizeClass), 'count': int(row.count), 'acreage': float(row.acreage)}
+        for row in class_table(frame).itertuples(index=False)
+    ]
+    return summarize_rows(rows, islands)
+
+def create_cube_table(conn):
+    # Burns and acreage per (year, month, island, size class) of each data
+    # set. Acreage is kept in hundredths of an acre so cells add up exactly,
+    # fires without acreage are counted in missing.
+    conn.execute('''CREATE TABLE IF NOT EXISTS burn_cube (
+                    data_set TEXT,
+                    source_mtime REAL,
+                    year TEXT,
+                    month TEXT,
+                    island TEXT,
+                    size_class TEXT,
+                    burns INTEGER,
+                    acreage_cents INTEGER,
+                    missing INTEGER
+                )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS burn_cube_data_set ON burn_cube (data_set, source_mtime)")
+
+def build_cube(frame):
+    acreage = round_acreage(frame['Acerage'])
+    missing = np.isnan(acreage)
+    cells = pd.DataFrame({
+        'year': frame['Year'].astype(object).to_numpy(),
+        'month': frame['FireMonth'].astype(object).to_numpy(),
+        'island': frame['Island'].astype(object).to_numpy(),
+        'size_class': size_classes(frame['Acerage']).astype(object),
+        'cents': np.rint(np.where(missing, 0, acreage) * 100).astype(np.int64),
+        'missing': missing.astype(np.int64),
+    })
+    groups = cells.groupby(cube_dimensions, dropna=False)
+    return groups.agg(burns=('cents', 'size'), acreage_cents=('cents', 'sum'), missing=('missing', 'sum')).reset_index()
+
+def write_cube(data_set, frame=None):
+    # Called at ingest, replaces the cube of a data set in one transaction
+    entry = dataset_cache.get(data_set, 'attributes') if frame is None else None
+    mtime = source_mtime(data_set)
+    cube = build_cube(entry['gdf'] if frame is None else frame)
+
+    rows = [
+        (data_set, mtime) + tuple(None if pd.isna(value) else str(value) for value in row[:4]) +
+        tuple(int(value) for value in row[4:])
+        for row in cube.itertuples(index=False)
+    ]
+
+    conn = sqlite3.connect(stats_db)
+    try:
+        with conn:
+            create_cube_table(conn)
+            conn.execute("DELETE FROM burn_cube WHERE data_set = ?", (data_set,))
+            conn.executemany("INSERT INTO burn_cube VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+    if debug:
+        print(f"Wrote {len(rows)} cube cells for '{data_set}'")
+    return len(rows)
+
+def delete_cube(data_set=None):
+    conn = sqlite3.connect(stats_db)
+    try:
+        with conn:
+            create_cube_table(conn)
+            if data_set is None:
+                conn.execute("DELETE FROM burn_cube")
+            else:
+                conn.execute("DELETE FROM burn_cube WHERE data_set = ?", (data_set,))
+    finally:
+        conn.close()
+
+def cube_rows(data_set, years, months, islands, by=()):
+    # Size class rows for a selection, summed from the cube cells. by adds
+    # cube dimensions to group on, e.g. ('island', 'year').
+    mtime = source_mtime(data_set)
+    conn = sqlite3.connect(stats_db)
+    try:
+        create_cube_table(conn)
+        # Cube missing or older than the shapefile, rebuild it first
+        if conn.execute("SELECT 1 FROM burn_cube WHERE data_set = ? AND source_mtime = ? LIMIT 1",
+                        (data_set, mtime)).fetchone() is None:
+            write_cube(data_set)
+            mtime = source_mtime(data_set)
+
+        conditions = ['data_set = ?', 'source_mtime = ?']
+        params = [data_set, mtime]
+        for column, selection in zip(cube_dimensions, (years, months, islands)):
+            values = split_selection(selection)
+            if values is not None:
+                conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+
+        group = ', '.join(list(by) + ['size_class'])
+        cells = conn.execute(f"SELECT {group}, SUM(burns), SUM(acreage_cents), SUM(missing) FROM burn_cube "
+                             f"WHERE {' AND '.join(conditions)} GROUP BY {group}", params).fetchall()
+        available_islands = [row[0] for row in conn.execute(
+            "SELECT DISTINCT island FROM burn_cube WHERE data_set = ? AND source_mtime = ? AND island IS NOT NULL",
+            (data_set, mtime))]
+    finally:
+        conn.close()
+
+    class_order = {label: i for i, label in enumerate(size_class_labels + [undefined_class])}
+    rows = []
+    for cell in cells:
+        *keys, size_class, burns, cents, missing = cell
+        row = {column: key for column, key in zip(by, keys)}
+        # A class with a fire without acreage shows NaN, like the old loop did
+        row.update({'sizeClass': size_class, 'count': burns, 'acreage': float('nan') if missing else cents / 100})
+        rows.append(row)
+    rows.sort(key=lambda row: tuple(str(row[column]) for column in by) + (class_order[row['sizeClass']],))
+    return rows, available_islands
+
+def cube_summary(data_set, years, months, islands):
+    # Legend numbers for a selection, no fire is read to get them
+    rows, available_islands = cube_rows(data_set, years, months, islands)
+    return summarize_rows(rows, selected_islands(available_islands, islands))
+
+def cube_breakdown(data_set, years, months, islands):
+    # Size class counts and acreage per island and year
+    rows, _ = cube_rows(data_set, years, months, islands, by=('island', 'year'))
+    return rows
+
+def json_number(value, digits=2):
+    # NaN is not valid JSON, send null instead
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return round(value, digits)
+
+def normalize_selection(selection):
+    return tuple(sorted(split_selection(selection) or []))
+
+def burn_stats(data_set, years, months, islands):
+    # The mtime is part of the memo key so a re-uploaded data set is
+    # recomputed
+    return cached_burn_stats(data_set, source_mtime(data_set), normalize_selection(years),
+                             normalize_selection(months), normalize_selection(islands))
+
+@lru_cache(maxsize=stats_cache_size)
+def cached_burn_stats(data_set, mtime, years, months, islands):
+    # Returned dicts are shared between callers, treat them as read-only
+    summary = cube_summary(data_set, list(years), list(months), list(islands))
+    if debug:
+        print(f"Computed stats for '{data_set}': {years} / {months} / {islands}")
+
+    return {
+        'dataSet': data_set,
+        'sizeClasses': [dict(row, acreage=json_number(row['acreage'])) for row in summary['sizeClasses']],
+        'totals': dict(summary['totals'], acreage=json_number(summary['totals']['acreage'])),
+        'landArea': summary['landArea'],
+        'percentBurned': json_number(summary['percentBurned']),
+    }
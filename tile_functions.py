@@ -0,0 +1,272 @@
+import hashlib
+import math
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import mapbox_vector_tile
+import numpy as np
+import pyproj
+import shapely
+
+from dataset_cache import dataset_cache, source_mtime
+from dataset_index import query_index
+from map_cache import make_key
+from vector_functions import level_for_zoom
+
+# Set debug flag
+debug = False
+
+# Tiles are kept under <tile_cache_dir>/<data set>/<selection>/<z>/<x>/<y>.mvt
+tile_cache_dir = os.path.join('output', 'tile_cache')
+
+# Disk budget for cut tiles, override with TILE_CACHE_MB. Every selection
+# gets its own tiles, the least recently used ones are deleted past this.
+max_tile_cache_bytes = int(os.environ.get('TILE_CACHE_MB', 512)) * 1024 * 1024
+
+# A tile file takes at least one block on disk, empty tiles included
+min_tile_bytes = 4096
+
+# Tiles used this recently are never trimmed, the request that cut or found
+# one may not have opened it yet
+trim_grace_seconds = 60
+
+# Zoom levels cut at upload for the unfiltered data set, TILE_SEED_MAX_ZOOM=-1
+# turns seeding off
+seed_max_zoom = int(os.environ.get('TILE_SEED_MAX_ZOOM', 6))
+
+layer_name = 'fires'
+tile_extent = 4096
+# Geometry past the tile edge that is kept so strokes don't get cut off
+tile_buffer = 64 / tile_extent
+
+# Half the width of the web mercator world in meters
+mercator_origin = 20037508.342789244
+
+to_web_mercator = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True)
+
+def tile_bounds(z, x, y):
+    # Web mercator bounds (minx, miny, maxx, maxy) of a tile
+    size = 2 * mercator_origin / 2 ** z
+    minx = -mercator_origin + x * size
+    maxy = mercator_origin - y * size
+    return minx, maxy - size, minx + size, maxy
+
+def tile_lonlat(z, x, y):
+    # Longitude/latitude of the north west corner of a tile
+    n = 2 ** z
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+def lonlat_tile(lon, lat, z):
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def valid_tile(z, x, y):
+    return 0 <= z <= 24 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def to_mercator_array(coords):
+    x, y = to_web_mercator.transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+def build_tile(entry, row_ids, z, x, y):
+    # Encodes the selected fires touching one tile, empty bytes if none do
+    gdf = entry['gdf']
+    west, north = tile_lonlat(z, x, y)
+    east, south = tile_lonlat(z, x + 1, y + 1)
+    pad_lon = (east - west) * tile_buffer
+    pad_lat = (north - south) * tile_buffer
+
+    # The spatial index lives on the cached frame so it is only built once
+    candidates = gdf.sindex.query(shapely.box(west - pad_lon, south - pad_lat, east + pad_lon, north + pad_lat))
+    candidates = np.intersect1d(candidates, row_ids)
+    if not len(candidates):
+        return b''
+
+    selected = gdf.iloc[candidates]
+    # Simplified geometry for this zoom when the data set has it
+    level = level_for_zoom(z)
+    geometries = selected['geometry'].values
+    if level is not None and level in entry['levels']:
+        geometries = entry['levels'][level][candidates]
+
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    scale = tile_extent / (maxx - minx)
+
+    # Move to tile pixels (y down) for every vertex at once, snapping to the
+    # pixel grid drops the vertices a client could never draw anyway
+    def to_tile_pixels(coords):
+        mercator = to_mercator_array(coords)
+        return np.column_stack([(mercator[:, 0] - minx) * scale, (maxy - mercator[:, 1]) * scale])
+
+    pad = tile_extent * tile_buffer
+    geometries = shapely.transform(np.asarray(geometries), to_tile_pixels)
+    geometries = shapely.clip_by_rect(geometries, -pad, -pad, tile_extent + pad, tile_extent + pad)
+    geometries = shapely.set_precision(geometries, 1.0)
+    # Exterior rings must have a positive area in tile coordinates
+    geometries = shapely.orient_polygons(geometries, exterior_cw=False)
+
+    features = []
+    for geometry, year, month, island, acreage in zip(geometries, selected['Year'], selected['FireMonth'],
+                                                        selected['Island'], selected['Acerage']):
+        if geometry is None or geometry.is_empty:
+            continue
+        properties = {'Acerage': round(float(acreage), 2)}
+        for key, value in (('Year', year), ('FireMonth', month), ('Island', island)):
+            if isinstance(value, str):
+                properties[key] = value
+        features.append({'geometry': geometry, 'properties': properties})
+
+    if not features:
+        return b''
+
+    # Geometries are already quantized and oriented, the encoder only packs them
+    return mapbox_vector_tile.encode(
+        [{'name': layer_name, 'features': features}],
+        default_options={'extents': tile_extent, 'y_coord_down': True, 'check_winding_order': False},
+    )
+
+class TileDiskIndex:
+    # Size and last use of every tile on disk in least recently used order,
+    # so the cache can be trimmed to its budget without walking the folder
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.trimmed = 0
+        self._tiles = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def used(self, path):
+        with self._lock:
+            self._load()
+            if path in self._tiles:
+                self._tiles.move_to_end(path)
+                self._tiles[path][1] = time.time()
+
+    def added(self, path):
+        size = max(os.path.getsize(path), min_tile_bytes)
+        with self._lock:
+            self._load()
+            if path in self._tiles:
+                self._size -= self._tiles.pop(path)[0]
+            self._tiles[path] = [size, time.time()]
+            self._size += size
+            self._trim()
+
+    def forget(self, data_set):
+        # Caller removes the folder
+        prefix = os.path.join(self.folder, data_set) + os.sep
+        with self._lock:
+            if self._tiles is None:
+                return
+            for path in [path for path in self._tiles if path.startswith(prefix)]:
+                self._size -= self._tiles.pop(path)[0]
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {'tiles': len(self._tiles), 'bytes': self._size, 'maxBytes': self.max_bytes, 'trimmed': self.trimmed}
+
+    def _trim(self):
+        # Caller holds the lock
+        now = time.time()
+        while self._size > self.max_bytes and self._tiles:
+            path, (size, last_used) = next(iter(self._tiles.items()))
+            if now - last_used < trim_grace_seconds:
+                break
+            del self._tiles[path]
+            self._size -= size
+            self.trimmed += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            # Drop the selection folders left empty, up to the data set
+            folder = os.path.dirname(path)
+            while os.path.dirname(folder) != self.folder:
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+
+    def _load(self):
+        # Caller holds the lock. Tiles left by an earlier run are picked up
+        # oldest first so they are the first to be trimmed.
+        if self._tiles is not None:
+            return
+        found = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith('.mvt'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, max(stat.st_size, min_tile_bytes)))
+        self._tiles = OrderedDict((path, [size, mtime]) for mtime, path, size in sorted(found))
+        self._size = sum(size for size, _ in self._tiles.values())
+
+tile_index = TileDiskIndex(tile_cache_dir, max_tile_cache_bytes)
+
+def tile_path(data_set, selection_key, z, x, y):
+    return os.path.join(tile_cache_dir, data_set, selection_key, str(z), str(x), f'{y}.mvt')
+
+def get_tile(data_set, z, x, y, years, months, islands):
+    # Returns (path, etag) of the cached tile, cutting it first if needed
+    selection_key = make_key(data_set, source_mtime(data_set), years, months, islands)
+    path = tile_path(data_set, selection_key, z, x, y)
+    etag = hashlib.sha256(f'{selection_key}/{z}/{x}/{y}'.encode('utf-8')).hexdigest()[:32]
+
+    if os.path.exists(path):
+        tile_index.used(path)
+    else:
+        entry = dataset_cache.get(data_set)
+        row_ids = query_index(entry['index'], years, months, islands)
+        write_tile(path, build_tile(entry, row_ids, z, x, y))
+        tile_index.added(path)
+        if debug:
+            print(f"Cut tile {data_set} {z}/{x}/{y}")
+
+    return path, etag
+
+def write_tile(path, tile):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as tile_file:
+        tile_file.write(tile)
+    os.replace(temp_path, path)
+
+def seed_tiles(data_set, max_zoom=None):
+    # Cuts the low zoom tiles of the unfiltered data set ahead of time
+    max_zoom = seed_max_zoom if max_zoom is None else max_zoom
+    if max_zoom < 0:
+        return 0
+
+    entry = dataset_cache.get(data_set)
+    if not len(entry['gdf']):
+        return 0
+    west, south, east, north = entry['gdf'].total_bounds
+
+    count = 0
+    for z in range(max_zoom + 1):
+        min_x, min_y = lonlat_tile(west, north, z)
+        max_x, max_y = lonlat_tile(east, south, z)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                get_tile(data_set, z, x, y, '', '', '')
+                count += 1
+
+    if debug:
+        print(f"Seeded {count} tiles for '{data_set}' up to zoom {max_zoom}")
+    return count
+
+def invalidate_tiles(data_set):
+    tile_index.forget(data_set)
+    shutil.rmtree(os.path.join(tile_cache_dir, data_set), ignore_errors=True)
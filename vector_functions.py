@@ -0,0 +1,56 @@
+import gzip
+import json
+
+import numpy as np
+import shapely
+
+# Set debug flag
+debug = False
+
+# Properties the map needs for styling and popups, everything else stays
+# on the server
+feature_properties = ['Year', 'FireMonth', 'Island', 'Acerage']
+
+# ~10cm at the equator, far below what a browser can draw
+coordinate_decimals = 6
+
+# Zoom levels that get a simplified copy of the geometry at ingest, past the
+# last one the full resolution polygons are served
+simplify_zooms = [6, 8, 10, 12, 14]
+
+def zoom_tolerance(zoom):
+    # Half a pixel of a 256px tile at the equator, in degrees
+    return 360.0 / (256 * 2 ** zoom) / 2
+
+def level_for_zoom(zoom):
+    # Coarsest simplified level that still looks right at this zoom
+    if zoom is None:
+        return None
+    for level in simplify_zooms:
+        if zoom <= level:
+            return level
+    return None
+
+def simplify_geometries(geometries, zoom):
+    # preserve_topology keeps every polygon valid and never drops a fire,
+    # however small it is at this zoom
+    return shapely.simplify(np.asarray(geometries), zoom_tolerance(zoom), preserve_topology=True)
+
+def round_geometries(geometries, decimals=coordinate_decimals):
+    return shapely.transform(np.asarray(geometries), lambda coords: np.round(coords, decimals))
+
+def features_geojson(gdf):
+    # Compact GeoJSON of the selected fires: rounded coordinates, only the
+    # properties the map uses and no whitespace
+    columns = [column for column in feature_properties if column in gdf.columns]
+    features = gdf[columns + ['geometry']].copy()
+    if 'Acerage' in features.columns:
+        features['Acerage'] = features['Acerage'].round(2)
+    for column in ('Year', 'FireMonth', 'Island'):
+        if column in features.columns:
+            features[column] = features[column].astype(object)
+    features['geometry'] = round_geometries(features['geometry'].values)
+    return json.dumps(features.to_geo_dict(drop_id=True), separators=(',', ':'))
+
+def gzip_bytes(payload):
+    return gzip.compress(payload.encode('utf-8') if isinstance(payload, str) else payload, compresslevel=6)